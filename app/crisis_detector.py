@@ -4,12 +4,103 @@ Multi-signal approach to detect mental health crisis indicators
 """
 
 import re
-from typing import List, Dict
+import bisect
+import functools
+from typing import List, Dict, NamedTuple, Optional, Tuple
 from datetime import datetime, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Joins messages in batch_analyze; patterns never match across a newline
+_BATCH_SEPARATOR = '\n\x00\n'
+
+# Fixed part of the result for messages that score zero
+_LOW_RISK_BASE = {
+    'risk_level': 'LOW',
+    'risk_level_numeric': 1,
+    'recommended_action': 'STANDARD_SUPPORT'
+}
+
+
+# Intervention guidance returned by get_intervention_guidance
+_GUIDANCE_HIGH = """
+            IMMEDIATE ACTION REQUIRED:
+            1. Human intervention needed within 5 minutes
+            2. Offer crisis resources immediately
+            3. Maintain connection - do not leave user alone
+            4. Consider emergency services if imminent danger
+            5. Document all interactions
+            """
+
+_GUIDANCE_MEDIUM = """
+            ENHANCED MONITORING:
+            1. Continue conversation with increased attention
+            2. Gently suggest professional resources
+            3. Monitor for escalation
+            4. Follow up within 24 hours if possible
+            """
+
+_GUIDANCE_LOW = """
+            STANDARD SUPPORT:
+            1. Provide empathetic, supportive responses
+            2. Continue normal conversation flow
+            3. Routine monitoring
+            """
+
+_GUIDANCE_BY_LEVEL = {
+    'HIGH': _GUIDANCE_HIGH,
+    'MEDIUM': _GUIDANCE_MEDIUM,
+    'LOW': _GUIDANCE_LOW
+}
+
+
+class BehavioralFlags(NamedTuple):
+    """Behavioral risk flags for a conversation"""
+    rapid_escalation: bool = False
+    late_night_distress: bool = False
+    conversation_length_concern: bool = False
+    message_frequency_spike: bool = False
+    
+    def as_dict(self) -> Dict[str, bool]:
+        """Plain dict form for logging and Datadog payloads"""
+        return self._asdict()
+
+
+def _fuse_patterns(named_patterns: Dict[str, str]) -> re.Pattern:
+    """
+    Compile {group_name: pattern} into a single case-insensitive alternation.
+    
+    Alternatives sit inside a zero-width lookahead so overlapping hits
+    (e.g. 'planned ... suicide' and 'suicide') are not consumed by an earlier
+    match. A leading \\b shared by every pattern is hoisted out of the
+    alternation, and when every alternative starts with a plain letter a
+    character-class guard rejects other word starts before any alternative
+    is tried (the same start-state skip a multi-pattern automaton does).
+    """
+    anchor = r'\b' if all(p.startswith(r'\b') for p in named_patterns.values()) else ''
+    bodies = [pattern[len(anchor):] for pattern in named_patterns.values()]
+    
+    guard = ''
+    first_chars = {body[:1] for body in bodies}
+    if all(c.isalnum() for c in first_chars):
+        guard = f"(?=[{''.join(sorted(first_chars))}])"
+    
+    alternation = '|'.join(
+        f"(?P<{name}>{body})" for name, body in zip(named_patterns, bodies)
+    )
+    return re.compile(f"{anchor}{guard}(?=(?:{alternation}))", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_timestamp(ts_str: str) -> Optional[float]:
+    """Epoch seconds for an ISO timestamp string, or None if it doesn't parse"""
+    try:
+        return datetime.fromisoformat(ts_str).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
 class CrisisDetector:
     """Detects crisis signals in conversation using multiple indicators"""
     
@@ -33,10 +124,11 @@ class CrisisDetector:
                 'weight': 0.9
             },
             'plan': {
+                # Gaps are bounded so a long message can't force quadratic backtracking
                 'patterns': [
-                    r'\bplanned\b.*\b(suicide|death)\b',
+                    r'\bplanned\b.{0,200}\b(suicide|death)\b',
                     r'\bhow to (kill|end)\b',
-                    r'\bmethods (of|for)\b.*\b(suicide|death)\b'
+                    r'\bmethods (of|for)\b.{0,200}\b(suicide|death)\b'
                 ],
                 'weight': 1.0
             },
@@ -78,6 +170,9 @@ class CrisisDetector:
             r'\btalking to someone\b', r'\bfamily supports\b', r'\bfriends care\b'
         ]
         
+        # Negative sentiment words for the escalation heuristic
+        self.negative_words = ['bad', 'worse', 'terrible', 'awful', 'can\'t', 'no']
+        
         # Crisis resources
         self.crisis_resources = [
             {
@@ -96,62 +191,99 @@ class CrisisDetector:
                 "available": "Global directory"
             }
         ]
+        
+        # Flat (category, weight, pattern) table in declaration order
+        self._pattern_table = tuple(
+            (category, config['weight'], pattern)
+            for category, config in self.crisis_patterns.items()
+            for pattern in config['patterns']
+        )
+        
+        # Fuse all patterns into one alternation so a message is scanned once
+        self._master_re = _fuse_patterns(
+            {f"g{row}": pattern for row, (_, _, pattern) in enumerate(self._pattern_table)}
+        )
+        # Regex group number -> table row (some patterns have inner groups)
+        self._group_rows = {
+            number: int(name[1:]) for name, number in self._master_re.groupindex.items()
+        }
+        self._protective_re = _fuse_patterns(
+            {f"p{i}": pattern for i, pattern in enumerate(self.protective_patterns)}
+        )
+        self._negative_re = _fuse_patterns(
+            {f"n{i}": re.escape(word) for i, word in enumerate(self.negative_words)}
+        )
+        
+        # Identical messages ("ok", "help me") recur constantly; cache the
+        # text-only part of the analysis per detector instance
+        self._keyword_analyze = functools.lru_cache(maxsize=4096)(self._score_keywords)
+        # History turns are re-read on every request; count each text once
+        self._negative_count = functools.lru_cache(maxsize=4096)(self._count_negative_words)
     
-    def analyze_message(self, message: str, conversation_history: List[Dict]) -> Dict:
+    def analyze_message(
+        self,
+        message: str,
+        conversation_history: List[Dict],
+        message_count: Optional[int] = None
+    ) -> Dict:
         """
         Analyze a message for crisis signals
         
+        Only the last few turns of conversation_history are read, so callers may
+        pass a recent slice along with the full conversation's message_count.
+        
         Returns:
             {
                 'crisis_score': float (0-1),
                 'risk_level': str (LOW/MEDIUM/HIGH),
                 'risk_level_numeric': int (1-3),
                 'detected_signals': list,
-                'behavioral_flags': dict,
+                'behavioral_flags': BehavioralFlags,
                 'resources': list,
                 'recommended_action': str
             }
         """
-        message_lower = message.lower()
-        detected_signals = []
-        crisis_score = 0.0
+        # One clock read serves the late-night check and the result timestamp
+        now = datetime.now()
         
-        # 1. Keyword-based detection
-        for category, config in self.crisis_patterns.items():
-            for pattern in config['patterns']:
-                if re.search(pattern, message_lower, re.IGNORECASE):
-                    detected_signals.append({
-                        'type': category,
-                        'weight': config['weight'],
-                        'matched_pattern': pattern
-                    })
-                    crisis_score += config['weight']
-                    logger.warning(f"Crisis signal detected: {category} in message")
-        
-        # 2. Check for protective factors
-        protective_count = 0
-        for pattern in self.protective_patterns:
-            if re.search(pattern, message_lower, re.IGNORECASE):
-                protective_count += 1
-        
-        # Reduce score based on protective factors
-        if protective_count > 0:
-            crisis_score *= (1 - (protective_count * 0.15))
+        # 1-2. Keyword detection and protective factors depend only on the text
+        crisis_score, signals = self._keyword_analyze(message)
+        
+        detected_signals = []
+        for category, weight, pattern in signals:
+            detected_signals.append({
+                'type': category,
+                'weight': weight,
+                'matched_pattern': pattern
+            })
+            logger.warning(f"Crisis signal detected: {category} in message")
         
         # 3. Behavioral analysis
         behavioral_flags = self._analyze_behavioral_patterns(
             message, 
-            conversation_history
+            conversation_history,
+            now,
+            message_count
         )
         
         # Adjust score based on behavioral flags
-        if behavioral_flags['rapid_escalation']:
+        if behavioral_flags.rapid_escalation:
             crisis_score += 0.2
-        if behavioral_flags['late_night_distress']:
+        if behavioral_flags.late_night_distress:
             crisis_score += 0.15
-        if behavioral_flags['conversation_length_concern']:
+        if behavioral_flags.conversation_length_concern:
             crisis_score += 0.1
         
+        # Neutral message and no behavioral concerns - the common case
+        if crisis_score == 0.0:
+            return {
+                **_LOW_RISK_BASE,
+                'crisis_score': 0.0,
+                'detected_signals': detected_signals,
+                'behavioral_flags': behavioral_flags,
+                'timestamp': now.isoformat()
+            }
+        
         # 4. Normalize score to 0-1 range
         crisis_score = min(crisis_score, 1.0)
         
@@ -176,7 +308,7 @@ class CrisisDetector:
             'detected_signals': detected_signals,
             'behavioral_flags': behavioral_flags,
             'recommended_action': recommended_action,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now.isoformat()
         }
         
         # Add resources if high risk
@@ -185,94 +317,159 @@ class CrisisDetector:
         
         return result
     
+    def batch_analyze(self, messages: List[str]) -> List[Dict]:
+        """
+        Keyword-only analysis for many messages at once (e.g. replaying history)
+        
+        The fused regexes run once over the joined messages and hits are
+        bucketed back to their source message by offset. Behavioral and
+        time-of-day factors are not applied.
+        
+        Returns:
+            [{'crisis_score': float (0-1), 'detected_signals': list}, ...]
+        """
+        if not messages:
+            return []
+        
+        # No pattern can match across a newline, so hits never span messages
+        starts = []
+        offset = 0
+        for message in messages:
+            starts.append(offset)
+            offset += len(message) + len(_BATCH_SEPARATOR)
+        joined = _BATCH_SEPARATOR.join(messages)
+        
+        crisis_hits = [set() for _ in messages]
+        for m in self._master_re.finditer(joined):
+            crisis_hits[bisect.bisect_right(starts, m.start()) - 1].add(self._group_rows[m.lastindex])
+        
+        protective_hits = [set() for _ in messages]
+        for m in self._protective_re.finditer(joined):
+            protective_hits[bisect.bisect_right(starts, m.start()) - 1].add(m.lastgroup)
+        
+        results = []
+        for matched, protective in zip(crisis_hits, protective_hits):
+            crisis_score, signals = self._score_matches(matched, len(protective))
+            results.append({
+                'crisis_score': round(min(crisis_score, 1.0), 3),
+                'detected_signals': [
+                    {'type': category, 'weight': weight, 'matched_pattern': pattern}
+                    for category, weight, pattern in signals
+                ]
+            })
+        
+        return results
+    
+    def _score_keywords(self, message: str) -> Tuple[float, Tuple[Tuple[str, float, str], ...]]:
+        """
+        Keyword and protective-factor scoring for a single message
+        
+        Returns (crisis_score, ((category, weight, pattern), ...)) as tuples so
+        the result can be shared through the LRU cache in _keyword_analyze.
+        """
+        matched = {self._group_rows[m.lastindex] for m in self._master_re.finditer(message)}
+        if not matched:
+            # Protective factors only scale the keyword score, which is zero here
+            return 0.0, ()
+        
+        protective_count = len({m.lastgroup for m in self._protective_re.finditer(message)})
+        return self._score_matches(matched, protective_count)
+    
+    def _score_matches(
+        self,
+        matched: set,
+        protective_count: int
+    ) -> Tuple[float, Tuple[Tuple[str, float, str], ...]]:
+        """Turn matched pattern table rows and a protective count into a score"""
+        
+        # 1. Keyword-based detection (each pattern counts once, in declaration order)
+        signals = tuple(self._pattern_table[row] for row in sorted(matched))
+        crisis_score = 0.0
+        for _, weight, _ in signals:
+            crisis_score += weight
+        
+        # 2. Reduce score based on protective factors
+        if protective_count > 0:
+            crisis_score *= (1 - (protective_count * 0.15))
+        
+        return crisis_score, signals
+    
     def _analyze_behavioral_patterns(
         self, 
         current_message: str, 
-        history: List[Dict]
-    ) -> Dict:
-        """Analyze behavioral patterns in conversation"""
-        
-        flags = {
-            'rapid_escalation': False,
-            'late_night_distress': False,
-            'conversation_length_concern': False,
-            'message_frequency_spike': False
-        }
+        history: List[Dict],
+        now: datetime,
+        message_count: Optional[int] = None
+    ) -> BehavioralFlags:
+        """Analyze behavioral patterns in conversation as of `now`"""
         
         # Check conversation length
-        if len(history) > 20:
-            flags['conversation_length_concern'] = True
+        if message_count is None:
+            message_count = len(history)
+        conversation_length_concern = message_count > 20
         
         # Check time of day (higher risk during late night/early morning)
-        current_hour = datetime.now().hour
-        if current_hour >= 23 or current_hour <= 5:
-            flags['late_night_distress'] = True
+        current_hour = now.hour
+        late_night_distress = current_hour >= 23 or current_hour <= 5
         
         # Check for rapid escalation in recent messages
+        rapid_escalation = False
         if len(history) >= 4:
             recent_messages = history[-4:]
             # Simple heuristic: look for increasing negative sentiment
-            negative_words = ['bad', 'worse', 'terrible', 'awful', 'can\'t', 'no']
-            negative_counts = []
+            user_messages = [msg for msg in recent_messages if msg.get('role') == 'user']
             
-            for msg in recent_messages:
-                if msg.get('role') == 'user':
-                    content = msg.get('content', '').lower()
-                    count = sum(1 for word in negative_words if word in content)
-                    negative_counts.append(count)
-            
-            # Check if sentiment is worsening
-            if len(negative_counts) >= 2:
-                if negative_counts[-1] > negative_counts[0]:
-                    flags['rapid_escalation'] = True
+            # Check if sentiment is worsening - only the oldest and newest
+            # user turns in the window are compared, so only those are scored
+            if len(user_messages) >= 2:
+                first_count = self._negative_word_count(user_messages[0])
+                last_count = self._negative_word_count(user_messages[-1])
+                rapid_escalation = last_count > first_count
         
         # Check message frequency (messages within short time window)
+        message_frequency_spike = False
         if len(history) >= 3:
             recent_messages = history[-3:]
             timestamps = []
             
             for msg in recent_messages:
-                ts_str = msg.get('timestamp')
-                if ts_str:
-                    try:
-                        timestamps.append(datetime.fromisoformat(ts_str))
-                    except:
-                        pass
+                ts = self._message_timestamp(msg)
+                if ts is not None:
+                    timestamps.append(ts)
             
             if len(timestamps) >= 2:
-                time_diff = (timestamps[-1] - timestamps[0]).total_seconds()
-                if time_diff < 60:  # 3+ messages in less than 1 minute
-                    flags['message_frequency_spike'] = True
+                time_diff = timestamps[-1] - timestamps[0]
+                # 3+ messages in less than 1 minute
+                message_frequency_spike = time_diff < 60
         
-        return flags
+        return BehavioralFlags(
+            rapid_escalation=rapid_escalation,
+            late_night_distress=late_night_distress,
+            conversation_length_concern=conversation_length_concern,
+            message_frequency_spike=message_frequency_spike
+        )
+    
+    def _negative_word_count(self, msg: Dict) -> int:
+        """Distinct negative words in a history message (cached per text)"""
+        return self._negative_count(msg.get('content', ''))
+    
+    def _count_negative_words(self, content: str) -> int:
+        return len({m.lastgroup for m in self._negative_re.finditer(content)})
+    
+    def _message_timestamp(self, msg: Dict) -> Optional[float]:
+        """
+        Message time in epoch seconds. Uses the integer ts_ns when present;
+        older messages carry an ISO timestamp, parsed once per string.
+        """
+        ts_ns = msg.get('ts_ns')
+        if ts_ns is not None:
+            return ts_ns / 1e9
+        ts_str = msg.get('timestamp')
+        if not ts_str:
+            return None
+        return _parse_timestamp(ts_str)
     
     def get_intervention_guidance(self, analysis: Dict) -> str:
         """Get specific intervention guidance based on analysis"""
         
-        risk_level = analysis['risk_level']
-        signals = analysis['detected_signals']
-        
-        if risk_level == 'HIGH':
-            return """
-            IMMEDIATE ACTION REQUIRED:
-            1. Human intervention needed within 5 minutes
-            2. Offer crisis resources immediately
-            3. Maintain connection - do not leave user alone
-            4. Consider emergency services if imminent danger
-            5. Document all interactions
-            """
-        elif risk_level == 'MEDIUM':
-            return """
-            ENHANCED MONITORING:
-            1. Continue conversation with increased attention
-            2. Gently suggest professional resources
-            3. Monitor for escalation
-            4. Follow up within 24 hours if possible
-            """
-        else:
-            return """
-            STANDARD SUPPORT:
-            1. Provide empathetic, supportive responses
-            2. Continue normal conversation flow
-            3. Routine monitoring
-            """
\ No newline at end of file
+        return _GUIDANCE_BY_LEVEL.get(analysis['risk_level'], _GUIDANCE_LOW)
@@ -1,22 +1,42 @@
 """
 Datadog Telemetry Module - Cloud Run Compatible
-Custom events and incident creation (no metrics/statsd)
+Custom events and incident creation, plus DogStatsD metrics when a local agent is available
 """
 
-from datadog import api, initialize
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import os
+import re
+import time
 import logging
 from datetime import datetime
-from typing import Dict, Optional
+from itertools import islice
+from typing import Dict, Iterator, Optional
 
 logger = logging.getLogger(__name__)
 
+_WORD_RE = re.compile(r'\S+')
+
 class DatadogTelemetry:
     """Custom Datadog integration for mental health monitoring"""
     
+    _EVENT_TITLE_FMT = "🚨 {level} Risk Crisis Detected - Session {sid}"
+    
     def __init__(self):
         # Check if running in Cloud Run
         self.is_cloud_run = os.environ.get('K_SERVICE') is not None
+        self.service = os.environ.get('DD_SERVICE', 'mental-health-bot')
+        self.env = os.environ.get('DD_ENV', 'production')
+        
+        # DogStatsD sends fire-and-forget UDP to the local agent and needs no
+        # API keys. Cloud Run has no agent, so there the request log record
+        # is the only metrics channel.
+        self.statsd = None
+        if not self.is_cloud_run:
+            from datadog import statsd
+            self.statsd = statsd
+        # Passed with every metric instead of mutating the shared client's constant_tags
+        self._statsd_tags = [f"service:{self.service}", f"env:{self.env}"]
         
         # Initialize Datadog API
         dd_api_key = os.environ.get('DD_API_KEY')
@@ -27,6 +47,10 @@ class DatadogTelemetry:
             self.enabled = False
             return
         
+        # Deferred so the API client is only loaded when keys are configured
+        from datadog import api, initialize
+        self._api = api
+        
         options = {
             'api_key': dd_api_key,
             'app_key': dd_app_key
@@ -34,15 +58,28 @@ class DatadogTelemetry:
         initialize(**options)
         
         self.enabled = True
-        self.service = os.environ.get('DD_SERVICE', 'mental-health-bot')
-        self.env = os.environ.get('DD_ENV', 'production')
+        
+        # Tags shared by every crisis event; only per-event tags are formatted per call
+        self._crisis_static_tags = (
+            f"service:{self.service}",
+            f"env:{self.env}",
+            "event_type:crisis_detection"
+        )
+        
+        # Datadog API calls are blocking HTTP requests; run them off the request path
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='dd-telemetry')
+        atexit.register(self._executor.shutdown, wait=True)
         
         mode = "Cloud Run" if self.is_cloud_run else "Local"
         logger.info(f"✅ Datadog telemetry initialized - Mode: {mode}, Service: {self.service}")
         
         # Send startup event
+        self._executor.submit(self._send_startup_event, mode)
+    
+    def _send_startup_event(self, mode: str):
+        """Send the application startup event (runs on the telemetry thread pool)"""
         try:
-            api.Event.create(
+            self._api.Event.create(
                 title=f"Application Started - {mode}",
                 text=f"Mental Health Crisis Monitor initialized successfully in {mode} mode",
                 tags=[
@@ -57,7 +94,10 @@ class DatadogTelemetry:
             logger.error(f"❌ Failed to send startup event: {e}")
     
     def record_custom_metric(self, metric_name: str, value: float, tags: list = None):
-        """Record metric via Datadog API (not statsd)"""
+        """Record a gauge via DogStatsD when an agent is available"""
+        if self.statsd is not None:
+            self.statsd.gauge(metric_name, value, tags=self._statsd_tags + (tags or []))
+            return
         if not self.enabled:
             return
         
@@ -65,6 +105,26 @@ class DatadogTelemetry:
         # since statsd doesn't work without an agent
         logger.info(f"📊 Metric recorded: {metric_name}={value}, tags={tags}")
     
+    def record_chat_metrics(self, crisis_analysis: Dict, llm_response: Dict, llm_latency_ms: float, total_latency_ms: float):
+        """Submit per-request chat metrics to DogStatsD (no-op without an agent)"""
+        statsd = self.statsd
+        if statsd is None:
+            return
+        
+        tags = self._statsd_tags + [f"risk_level:{crisis_analysis['risk_level'].lower()}"]
+        statsd.increment('llm.requests', tags=tags)
+        statsd.histogram('llm.latency', llm_latency_ms, tags=tags)
+        statsd.histogram('request.latency', total_latency_ms, tags=tags)
+        statsd.histogram('crisis.score', crisis_analysis['crisis_score'], tags=tags)
+        if llm_response.get('cached'):
+            statsd.increment('llm.cache_hits', tags=tags)
+        else:
+            statsd.histogram('llm.tokens.input', llm_response.get('input_tokens', 0), tags=tags)
+            statsd.histogram('llm.tokens.output', llm_response.get('output_tokens', 0), tags=tags)
+            statsd.histogram('llm.cost', llm_response.get('estimated_cost', 0), tags=tags)
+        if crisis_analysis['risk_level'] == 'HIGH':
+            statsd.increment('crisis.high_risk_detected', tags=self._statsd_tags)
+    
     def create_crisis_event(
         self,
         session_id: str,
@@ -81,63 +141,78 @@ class DatadogTelemetry:
         risk_level = crisis_analysis['risk_level']
         crisis_score = crisis_analysis['crisis_score']
         
-        # Anonymize message
-        words = user_message.split()
-        if len(words) > 10:
-            anonymized = f"{' '.join(words[:3])} [...] {' '.join(words[-3:])}"
-        else:
-            anonymized = "[Content anonymized for privacy]"
-        
-        event_title = f"🚨 {risk_level} Risk Crisis Detected - Session {session_id[:8]}"
-        
-        event_text = f"""
-## Crisis Alert: {risk_level} Risk Detected
-
-**Crisis Score:** {crisis_score}
-
-**Session Information:**
-- Session ID: `{session_id}`
-- Message Count: {len(session_context.get('messages', []))}
-- Session Duration: {self._calculate_duration(session_context.get('created_at'))}
-- Total Tokens: {session_context.get('total_tokens', 0)}
-- Estimated Cost: ${session_context.get('total_cost', 0):.4f}
-
-**Detected Signals:**
-{self._format_signals(crisis_analysis.get('detected_signals', []))}
-
-**Behavioral Flags:**
-{self._format_behavioral_flags(crisis_analysis.get('behavioral_flags', {}))}
-
-**Recommended Action:** {crisis_analysis.get('recommended_action', 'UNKNOWN')}
-
-**Crisis Resources Provided:** {'Yes' if crisis_analysis.get('resources') else 'No'}
-
-**Anonymized Message:** {anonymized}
-
----
-**Next Steps:**
-1. Review full conversation in logs
-2. Verify crisis resources were provided to user
-3. Consider human intervention if HIGH risk
-4. Document response actions taken
-        """
+        anonymized = self._anonymize_message(user_message)
+        
+        event_title = self._EVENT_TITLE_FMT.format(level=risk_level, sid=session_id[:8])
+        
+        # Assemble the markdown body line by line and join once
+        lines = [
+            "",
+            f"## Crisis Alert: {risk_level} Risk Detected",
+            "",
+            f"**Crisis Score:** {crisis_score}",
+            "",
+            "**Session Information:**",
+            f"- Session ID: `{session_id}`",
+            f"- Message Count: {session_context.get('message_count', len(session_context.get('messages', [])))}",
+            f"- Session Duration: {self._calculate_duration(session_context.get('created_at'))}",
+            f"- Total Tokens: {session_context.get('total_tokens', 0)}",
+            f"- Estimated Cost: ${session_context.get('total_cost', 0):.4f}",
+            "",
+            "**Detected Signals:**",
+        ]
+        lines.extend(self._signal_lines(crisis_analysis.get('detected_signals', [])))
+        lines.append("")
+        lines.append("**Behavioral Flags:**")
+        lines.extend(self._behavioral_flag_lines(crisis_analysis.get('behavioral_flags')))
+        lines.extend([
+            "",
+            f"**Recommended Action:** {crisis_analysis.get('recommended_action', 'UNKNOWN')}",
+            "",
+            f"**Crisis Resources Provided:** {'Yes' if crisis_analysis.get('resources') else 'No'}",
+            "",
+            f"**Anonymized Message:** {anonymized}",
+            "",
+            "---",
+            "**Next Steps:**",
+            "1. Review full conversation in logs",
+            "2. Verify crisis resources were provided to user",
+            "3. Consider human intervention if HIGH risk",
+            "4. Document response actions taken",
+        ])
+        event_text = "\n".join(lines)
         
         alert_type = 'error' if risk_level == 'HIGH' else 'warning'
         priority = 'normal' if risk_level != 'HIGH' else 'normal'
         
+        tags = [
+            f"session_id:{session_id}",
+            f"risk_level:{risk_level.lower()}",
+            f"crisis_score:{crisis_score}",
+            f"action:{crisis_analysis.get('recommended_action', 'unknown').lower()}",
+            *self._crisis_static_tags
+        ]
+        
+        # The event text is built above so it reflects the session as it is now
+        self._executor.submit(
+            self._send_crisis_event, event_title, event_text, tags, alert_type, priority, risk_level
+        )
+    
+    def _send_crisis_event(
+        self,
+        title: str,
+        text: str,
+        tags: list,
+        alert_type: str,
+        priority: str,
+        risk_level: str
+    ):
+        """Send a crisis event to Datadog (runs on the telemetry thread pool)"""
         try:
-            result = api.Event.create(
-                title=event_title,
-                text=event_text,
-                tags=[
-                    f"session_id:{session_id}",
-                    f"risk_level:{risk_level.lower()}",
-                    f"crisis_score:{crisis_score}",
-                    f"service:{self.service}",
-                    f"env:{self.env}",
-                    "event_type:crisis_detection",
-                    f"action:{crisis_analysis.get('recommended_action', 'unknown').lower()}"
-                ],
+            result = self._api.Event.create(
+                title=title,
+                text=text,
+                tags=tags,
                 alert_type=alert_type,
                 priority=priority
             )
@@ -147,45 +222,55 @@ class DatadogTelemetry:
         except Exception as e:
             logger.error(f"❌ Failed to create Datadog event: {str(e)}")
     
-    def _format_signals(self, signals: list) -> str:
-        """Format detected crisis signals"""
+    def _signal_lines(self, signals: list) -> Iterator[str]:
+        """Yield formatted lines for detected crisis signals"""
         if not signals:
-            return "- No specific crisis keywords detected"
+            yield "- No specific crisis keywords detected"
+            return
         
-        formatted = []
         for signal in signals:
             signal_type = signal.get('type', 'unknown')
             weight = signal.get('weight', 0)
-            formatted.append(f"- **{signal_type}** (weight: {weight})")
-        
-        return "\n".join(formatted)
+            yield f"- **{signal_type}** (weight: {weight})"
     
-    def _format_behavioral_flags(self, flags: dict) -> str:
-        """Format behavioral flags"""
+    def _behavioral_flag_lines(self, flags) -> Iterator[str]:
+        """Yield formatted lines for behavioral flags (a BehavioralFlags tuple)"""
         if not flags:
-            return "- No behavioral concerns detected"
+            yield "- No behavioral concerns detected"
+            return
         
-        formatted = []
-        for flag, value in flags.items():
+        for flag, value in flags.as_dict().items():
             status = "⚠️ YES" if value else "✓ No"
             flag_name = flag.replace('_', ' ').title()
-            formatted.append(f"- {flag_name}: {status}")
-        
-        return "\n".join(formatted)
+            yield f"- {flag_name}: {status}"
+    
+    def _anonymize_message(self, message: str) -> str:
+        """Keep only the first and last three words of messages over ten words"""
+        # Stop scanning after the 11th word instead of splitting the whole message
+        head = [m.group() for m in islice(_WORD_RE.finditer(message), 11)]
+        if len(head) <= 10:
+            return "[Content anonymized for privacy]"
+        
+        tail = message.rsplit(None, 3)[-3:]
+        return f"{' '.join(head[:3])} [...] {' '.join(tail)}"
     
     def _calculate_duration(self, created_at) -> str:
         """Calculate session duration"""
         if not created_at:
             return "Unknown"
         
-        if isinstance(created_at, str):
-            try:
-                created_at = datetime.fromisoformat(created_at)
-            except:
-                return "Unknown"
-        
-        duration = datetime.now() - created_at
-        minutes = int(duration.total_seconds() / 60)
+        # Sessions record creation as epoch seconds
+        if isinstance(created_at, (int, float)):
+            elapsed = time.time() - created_at
+        else:
+            if isinstance(created_at, str):
+                try:
+                    created_at = datetime.fromisoformat(created_at)
+                except:
+                    return "Unknown"
+            elapsed = (datetime.now() - created_at).total_seconds()
+        
+        minutes = int(elapsed / 60)
         
         if minutes < 1:
             return "< 1 minute"
@@ -0,0 +1,63 @@
+"""
+LLM Request Batcher
+Coalesces concurrent /chat generations of the same prompt into one Vertex AI call
+"""
+
+import asyncio
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _shared_result(result: Dict) -> Dict:
+    """A reply reused from another request's call, without that call's usage"""
+    return {**result, 'input_tokens': 0, 'output_tokens': 0,
+            'total_tokens': 0, 'estimated_cost': 0.0, 'cached': True}
+
+
+class LLMBatcher:
+    """
+    Sits in front of VertexAIClient and lets identical concurrent prompts share
+    one generate_response call. Gemini has no multi-conversation endpoint, so
+    deduplication is the only saving; requests are never held back waiting for
+    a batch to fill.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._running = False
+        # dedup_key -> the Vertex call currently generating that reply
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def start(self):
+        """Start coalescing requests (call from the running event loop)"""
+        self._running = True
+        logger.info("LLM batcher started")
+
+    async def stop(self):
+        """Stop coalescing and wait for calls already sent to Vertex AI to finish"""
+        self._running = False
+        if self._inflight:
+            await asyncio.gather(*self._inflight.values(), return_exceptions=True)
+
+    async def generate(self, dedup_key: Optional[str] = None, **request) -> Dict:
+        """
+        Run one generate_response call, or join the identical one in flight.
+        Requests with the same dedup_key share one LLM call, and only the first
+        is charged for it; pass None for requests that must always be generated
+        on their own. HIGH risk requests are never shared.
+        """
+        crisis_context = request.get('crisis_context') or {}
+        if not self._running or dedup_key is None or crisis_context.get('risk_level') == 'HIGH':
+            return await self.client.generate_response(**request)
+
+        task = self._inflight.get(dedup_key)
+        if task is not None:
+            # Shielded so one caller going away doesn't cancel the call for the rest
+            return _shared_result(await asyncio.shield(task))
+
+        task = asyncio.create_task(self.client.generate_response(**request))
+        self._inflight[dedup_key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(dedup_key, None))
+        return await asyncio.shield(task)
@@ -4,14 +4,19 @@ Monitors LLM conversations for crisis signals with Datadog observability
 """
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional
 import uvicorn
-from datetime import datetime
-import uuid
+import secrets
 import time
 import os
+import hashlib
+import asyncio
+import orjson
+import gzip
+from contextlib import asynccontextmanager
 
 # Configure Datadog for Cloud Run BEFORE any imports
 IS_CLOUD_RUN = os.environ.get('K_SERVICE') is not None  # Cloud Run sets K_SERVICE
@@ -32,11 +37,19 @@ if IS_CLOUD_RUN:
     
     # Disable Doglogger (no agent in Cloud Run)
     os.environ['DD_DOGlogger_DISABLE'] = 'true'
+    
+    # Head-based sampling: keep 10% of routine traces. HIGH risk and failed
+    # chats are force-kept in chat(), so they are never sampled out.
+    os.environ.setdefault('DD_TRACE_SAMPLE_RATE', '0.1')
+    os.environ.setdefault('DD_TRACE_SAMPLING_RULES', f'[{{"service": "{DD_SERVICE}", "sample_rate": 0.1}}]')
 
 # Now import Datadog
 from ddtrace import tracer, patch_all, config
-from datadog import initialize, api
+from ddtrace.constants import MANUAL_KEEP_KEY
 import logging
+import logging.handlers
+import queue
+import atexit
 
 # Patch all for APM
 patch_all()
@@ -48,39 +61,115 @@ config.version = '1.0.0'
 
 # Initialize Datadog API (for events only, no metrics)
 if DD_API_KEY:
+    # Only pay for the datadog SDK import when events can actually be sent
+    from datadog import initialize
+    
     dd_options = {
         'api_key': DD_API_KEY,
         'app_key': os.environ.get('DD_APP_KEY'),
     }
     initialize(**dd_options)
 
-# Setup logging
+# Setup logging. Handlers only enqueue records; a background listener thread
+# does the formatting and stderr writes, so request handlers never block on I/O.
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+
+def _start_log_listener():
+    global _log_listener
+    _log_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, _log_stream)
+    _log_listener.start()
+
+_start_log_listener()
+# gunicorn preloads this module and then forks; threads don't survive the
+# fork, so each worker starts its own listener on a fresh queue
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(message)s',  # QueueHandler only merges args; _log_stream applies the real format
+    handlers=[_log_handler]
 )
 logger = logging.getLogger(__name__)
 logger.info(f"Starting in {'Cloud Run' if IS_CLOUD_RUN else 'Local'} mode")
 
-app = FastAPI(title="Mental Health Support Bot")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Build the per-worker components. Imports are shared across gunicorn workers
+    via preload_app, but gRPC channels and executor threads must not cross the
+    fork, so clients are created here, inside each worker.
+    """
+    state = app.state
+    state.vertex_client = VertexAIClient()
+    state.llm_batcher = LLMBatcher(state.vertex_client)
+    state.crisis_detector = CrisisDetector()
+    state.dd_telemetry = DatadogTelemetry()
+    # Session storage (Redis when REDIS_URL is set, otherwise in-memory)
+    state.session_store = create_session_store()
+    
+    logger.info("Mental Health Crisis Monitor starting up")
+    logger.info('app.startup')
+    state.llm_batcher.start()
+    state.session_store.start()
+    yield
+    await state.llm_batcher.stop()
+    await state.session_store.stop()
+
+app = FastAPI(title="Mental Health Support Bot", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Chat UI and any other static assets ship alongside this module
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+INDEX_HTML = os.path.join(STATIC_DIR, "index.html")
+# Read and compress the page once; every request reuses these bytes
+with open(INDEX_HTML, 'rb') as f:
+    INDEX_BYTES = f.read()
+INDEX_GZ = gzip.compress(INDEX_BYTES, 6)
+INDEX_ETAG = f'"{hashlib.sha1(INDEX_BYTES).hexdigest()}"'
+INDEX_HEADERS = {"Cache-Control": "public, max-age=3600", "ETag": INDEX_ETAG, "Vary": "Accept-Encoding"}
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 # Import custom modules AFTER Datadog setup
 from app.vertex_ai_client import VertexAIClient
 from app.crisis_detector import CrisisDetector
 from app.datadog_telemetry import DatadogTelemetry
+from app.session_store import create_session_store, recent_messages
+from app.llm_batcher import LLMBatcher
+
+# Conversation context sent to the detector and the LLM (5 user/assistant turns)
+MAX_HISTORY_MESSAGES = 10
 
-# Initialize components
-vertex_client = VertexAIClient()
-crisis_detector = CrisisDetector()
-dd_telemetry = DatadogTelemetry()
+# Messages shorter than this are scanned inline (~tens of µs); longer ones go
+# to a worker thread so the scan can't hold up other requests
+INLINE_DETECTION_MAX_CHARS = 512
 
-# In-memory session storage
-sessions = {}
+# Canned reply for messages too short to analyze
+TRIVIAL_MESSAGE_RESPONSE = "Could you tell me a bit more about how you're feeling?"
+
+# SAFE fallback reply when a chat request fails
+CHAT_ERROR_RESPONSE = "I'm having trouble processing your message right now, but I'm here to listen. Could you try rephrasing?"
+
+# Event streams must reach the client unbuffered by proxies and caches
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _llm_cache_key(user_message: str, risk_level: str, history: List[dict]) -> Optional[str]:
+    """Key for reusing an LLM reply; HIGH risk replies are always generated fresh"""
+    if risk_level == 'HIGH':
+        return None
+    # Case and spacing don't change the reply, so "Help" and "help " share an entry
+    normalized = " ".join(user_message.lower().split())
+    key = orjson.dumps([normalized, risk_level, [(m.get('role'), m['content']) for m in history[-4:]]])
+    return hashlib.blake2b(key, digest_size=16).hexdigest()
 
 class Message(BaseModel):
+    # Unknown fields are dropped; oversized strings are rejected during validation
+    model_config = ConfigDict(extra="ignore", str_max_length=8192)
+    
     session_id: Optional[str] = None
     user_message: str
-    user_metadata: Optional[dict] = {}
+    user_metadata: Optional[dict] = Field(default_factory=dict)
 
 class SessionMetrics(BaseModel):
     session_id: str
@@ -89,300 +178,16 @@ class SessionMetrics(BaseModel):
     risk_level: str
     conversation_duration: float
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Mental Health Crisis Monitor starting up")
-    logger.info('app.startup')
-
 @app.get("/", response_class=HTMLResponse)
-async def root():
+async def root(request: Request):
     """Serve the chat interface"""
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Mental Health Support Chat</title>
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }
-            
-            body {
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 20px;
-            }
-            
-            .chat-container {
-                background: white;
-                border-radius: 16px;
-                padding: 30px;
-                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                width: 100%;
-                max-width: 800px;
-                height: 90vh;
-                display: flex;
-                flex-direction: column;
-            }
-            
-            h1 {
-                color: #667eea;
-                margin-bottom: 20px;
-                font-size: 28px;
-                font-weight: 600;
-            }
-            
-            .crisis-banner {
-                background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-                color: white;
-                padding: 16px 20px;
-                border-radius: 10px;
-                margin-bottom: 20px;
-                display: none;
-                animation: slideIn 0.3s ease-out;
-            }
-            
-            @keyframes slideIn {
-                from {
-                    transform: translateY(-20px);
-                    opacity: 0;
-                }
-                to {
-                    transform: translateY(0);
-                    opacity: 1;
-                }
-            }
-            
-            .crisis-banner strong {
-                display: block;
-                margin-bottom: 8px;
-                font-size: 16px;
-            }
-            
-            .crisis-banner a {
-                color: white;
-                text-decoration: underline;
-            }
-            
-            .messages {
-                flex: 1;
-                overflow-y: auto;
-                padding: 20px;
-                border: 2px solid #f0f0f0;
-                border-radius: 10px;
-                margin-bottom: 20px;
-                background: #fafafa;
-            }
-            
-            .message {
-                margin-bottom: 16px;
-                padding: 12px 16px;
-                border-radius: 12px;
-                max-width: 80%;
-                animation: messageSlide 0.2s ease-out;
-                line-height: 1.6;
-            }
-            
-            @keyframes messageSlide {
-                from {
-                    transform: translateY(10px);
-                    opacity: 0;
-                }
-                to {
-                    transform: translateY(0);
-                    opacity: 1;
-                }
-            }
-            
-            .user {
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                margin-left: auto;
-                text-align: right;
-                border-bottom-right-radius: 4px;
-            }
-            
-            .bot {
-                background: white;
-                color: #333;
-                border: 2px solid #e0e0e0;
-                margin-right: auto;
-                border-bottom-left-radius: 4px;
-                white-space: pre-wrap;
-            }
-            
-            .typing {
-                display: none;
-                background: white;
-                border: 2px solid #e0e0e0;
-                color: #666;
-                font-style: italic;
-                max-width: 100px;
-            }
-            
-            .input-area {
-                display: flex;
-                gap: 12px;
-            }
-            
-            input {
-                flex: 1;
-                padding: 14px 18px;
-                border: 2px solid #e0e0e0;
-                border-radius: 10px;
-                font-size: 15px;
-                transition: border-color 0.2s;
-            }
-            
-            input:focus {
-                outline: none;
-                border-color: #667eea;
-            }
-            
-            button {
-                padding: 14px 32px;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                border: none;
-                border-radius: 10px;
-                cursor: pointer;
-                font-size: 15px;
-                font-weight: 600;
-                transition: transform 0.1s, box-shadow 0.2s;
-            }
-            
-            button:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 4px 12px rgba(102, 126, 234, 0.4);
-            }
-            
-            button:active {
-                transform: translateY(0);
-            }
-            
-            button:disabled {
-                opacity: 0.6;
-                cursor: not-allowed;
-                transform: none;
-            }
-            
-            .messages::-webkit-scrollbar {
-                width: 8px;
-            }
-            
-            .messages::-webkit-scrollbar-track {
-                background: #f0f0f0;
-                border-radius: 10px;
-            }
-            
-            .messages::-webkit-scrollbar-thumb {
-                background: #c0c0c0;
-                border-radius: 10px;
-            }
-            
-            .messages::-webkit-scrollbar-thumb:hover {
-                background: #a0a0a0;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="chat-container">
-            <h1>🤝 Mental Health Support</h1>
-            <div id="crisis-banner" class="crisis-banner">
-                <strong>⚠️ Crisis Resources Available</strong>
-                If you're in crisis: <a href="tel:988">988 Suicide & Crisis Lifeline</a> | 
-                Text HOME to 741741
-            </div>
-            <div id="messages" class="messages">
-                <div class="message bot">
-                    Hello, I'm here to listen and support you. How are you feeling today?
-                </div>
-            </div>
-            <div class="message typing" id="typing">Thinking...</div>
-            <div class="input-area">
-                <input type="text" id="userInput" placeholder="Type your message..." />
-                <button onclick="sendMessage()" id="sendBtn">Send</button>
-            </div>
-        </div>
-        
-        <script>
-            let sessionId = localStorage.getItem('session_id') || Math.random().toString(36).substr(2, 9);
-            localStorage.setItem('session_id', sessionId);
-            
-            async function sendMessage() {
-                const input = document.getElementById('userInput');
-                const sendBtn = document.getElementById('sendBtn');
-                const typing = document.getElementById('typing');
-                const message = input.value.trim();
-                
-                if (!message) return;
-                
-                // Disable input while processing
-                input.disabled = true;
-                sendBtn.disabled = true;
-                typing.style.display = 'block';
-                
-                addMessage('user', message);
-                input.value = '';
-                
-                try {
-                    const response = await fetch('/chat', {
-                        method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({
-                            session_id: sessionId,
-                            user_message: message
-                        })
-                    });
-                    
-                    const data = await response.json();
-                    
-                    typing.style.display = 'none';
-                    addMessage('bot', data.response);
-                    
-                    if (data.crisis_detected) {
-                        document.getElementById('crisis-banner').style.display = 'block';
-                    }
-                } catch (error) {
-                    typing.style.display = 'none';
-                    addMessage('bot', 'I apologize, but I encountered an error. Please try again.');
-                    console.error('Error:', error);
-                } finally {
-                    input.disabled = false;
-                    sendBtn.disabled = false;
-                    input.focus();
-                }
-            }
-            
-            function addMessage(sender, text) {
-                const messagesDiv = document.getElementById('messages');
-                const messageDiv = document.createElement('div');
-                messageDiv.className = `message ${sender}`;
-                messageDiv.textContent = text;
-                messagesDiv.appendChild(messageDiv);
-                messagesDiv.scrollTop = messagesDiv.scrollHeight;
-            }
-            
-            document.getElementById('userInput').addEventListener('keypress', function(e) {
-                if (e.key === 'Enter' && !e.shiftKey) {
-                    e.preventDefault();
-                    sendMessage();
-                }
-            });
-            
-            // Focus input on load
-            document.getElementById('userInput').focus();
-        </script>
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
+    # Browsers revalidating an unchanged page get an empty 304
+    if_none_match = request.headers.get("if-none-match", "")
+    if INDEX_ETAG in [tag.strip(" W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(INDEX_GZ, media_type="text/html", headers={**INDEX_HEADERS, "Content-Encoding": "gzip"})
+    return Response(INDEX_BYTES, media_type="text/html", headers=INDEX_HEADERS)
 
 # @app.post("/chat")
 # @tracer.wrap(service="mental-health-bot", resource="chat")
@@ -508,114 +313,186 @@ async def root():
 #             span.set_tag("error.message", str(e))
 #         raise HTTPException(status_code=500, detail="Error processing message")
 
+async def _detect_crisis(state, user_message: str, recent: List[dict], message_count: int) -> dict:
+    """Crisis detection, run BEFORE the LLM call"""
+    # Short messages scan faster than a thread hand-off costs, so only long
+    # ones leave the event loop
+    if len(user_message) < INLINE_DETECTION_MAX_CHARS:
+        return state.crisis_detector.analyze_message(user_message, recent, message_count)
+    return await asyncio.to_thread(
+        state.crisis_detector.analyze_message,
+        user_message,
+        recent,
+        message_count
+    )
+
+def _tag_crisis(span, crisis_analysis: dict):
+    """SAFE Datadog tags (after crisis_analysis exists)"""
+    if span and crisis_analysis:
+        span.set_tags({
+            "service": "mental-health-bot",
+            "env": "production",
+            "crisis.score": crisis_analysis['crisis_score'],
+            "risk_level": crisis_analysis['risk_level'],
+            "llm.model": "gemini-2.0-flash-lite-001"
+        })
+
+async def _record_turn(
+    state,
+    session_id: str,
+    session: dict,
+    user_message: str,
+    crisis_analysis: dict,
+    llm_response: dict,
+    llm_latency: float,
+    start_time: float,
+    span=None
+) -> bool:
+    """Persist the exchange, raise the crisis event and log the request record.
+    Returns whether a HIGH risk crisis was detected."""
+    crisis_detected = False
+    
+    # Update session
+    now_ns = time.time_ns()
+    await state.session_store.save_turn(
+        session_id,
+        session,
+        [
+            {
+                "role": "user",
+                "content": user_message,
+                "ts_ns": now_ns
+            },
+            {
+                "role": "assistant",
+                "content": llm_response['text'],
+                "ts_ns": now_ns
+            }
+        ],
+        crisis_score=crisis_analysis['crisis_score'],
+        tokens=llm_response.get('total_tokens', 0),
+        cost=llm_response.get('estimated_cost', 0)
+    )
+    
+    # Create Datadog event if HIGH risk
+    if crisis_analysis and crisis_analysis['risk_level'] == 'HIGH':
+        state.dd_telemetry.create_crisis_event(
+            session_id=session_id,
+            crisis_analysis=crisis_analysis,
+            user_message=user_message,
+            session_context=session
+        )
+        logger.info('crisis.high_risk_detected')
+        crisis_detected = True
+        if span:
+            span.set_tag(MANUAL_KEEP_KEY)
+    
+    # Calculate response time
+    total_latency = time.time() - start_time
+    
+    state.dd_telemetry.record_chat_metrics(crisis_analysis, llm_response, llm_latency * 1000, total_latency * 1000)
+    
+    # All per-request metrics go out as one JSON record, rendered once by
+    # orjson so Datadog log ingestion picks the fields up as attributes.
+    # Skip building it at all when INFO is filtered out.
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("chat_processed %s", orjson.dumps({
+            "session_id": session_id,
+            "crisis_score": crisis_analysis['crisis_score'] if crisis_analysis else 0,
+            "risk_level": crisis_analysis['risk_level'] if crisis_analysis else 'UNKNOWN',
+            "risk_level_numeric": crisis_analysis['risk_level_numeric'] if crisis_analysis else 1,
+            "llm_latency_ms": llm_latency * 1000,
+            "llm_cache_hit": llm_response.get('cached', False),
+            "total_latency_ms": total_latency * 1000,
+            "tokens_input": llm_response.get('input_tokens', 0),
+            "tokens_output": llm_response.get('output_tokens', 0),
+            "tokens_used": llm_response.get('total_tokens', 0),
+            "llm_cost": llm_response.get('estimated_cost', 0)
+        }).decode())
+    
+    return crisis_detected
+
+def _log_chat_error(e: Exception):
+    """Log a failed chat request; the traceback is only captured when ERROR is enabled"""
+    if logger.isEnabledFor(logging.ERROR):
+        logger.error("Error processing chat: %s", e, exc_info=True)
+    logger.info('errors.chat_processing')
+
+def _cached_llm_response(cached: dict) -> dict:
+    """Reused reply costs nothing, so don't count its tokens again"""
+    return {**cached, 'input_tokens': 0, 'output_tokens': 0,
+            'total_tokens': 0, 'estimated_cost': 0.0, 'cached': True}
+
+def _sse(event: str, data: dict) -> bytes:
+    """One Server-Sent Events frame"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
 @app.post("/chat")
 @tracer.wrap(service="mental-health-bot", resource="chat")
-async def chat(message: Message):
+async def chat(message: Message, request: Request):
     """Handle chat messages with full observability"""
     
     start_time = time.time()
-    session_id = message.session_id or str(uuid.uuid4())
+    state = request.app.state
+    session_id = message.session_id or secrets.token_hex(8)
+    user_message = message.user_message.strip()
     
-    # Initialize session if new
-    if session_id not in sessions:
-        sessions[session_id] = {
-            "messages": [],
-            "created_at": datetime.now(),
-            "crisis_scores": [],
-            "total_tokens": 0,
-            "total_cost": 0.0
+    # Nothing to analyze or answer (empty / single character) - skip detection and the LLM
+    if len(user_message) < 2:
+        return {
+            "session_id": session_id,
+            "response": TRIVIAL_MESSAGE_RESPONSE,
+            "crisis_detected": False,
+            "risk_level": "LOW",
+            "crisis_resources": []
         }
+    
+    # Initialize session if new
+    session, created = await state.session_store.get_or_create(session_id)
+    if created:
         logger.info('sessions.created')
     
-    session = sessions[session_id]
-    user_message = message.user_message
+    # Only recent turns are needed below; the true length travels separately
+    recent = recent_messages(session, MAX_HISTORY_MESSAGES)
+    message_count = session["message_count"]
     
     # Add span tags for Datadog APM
     span = tracer.current_span()
     if span:
-        span.set_tag("session_id", session_id)
-        span.set_tag("message_length", len(user_message))
-        span.set_tag("message_count", len(session["messages"]))
+        # Short prefix keeps tag cardinality down; it matches the crisis event title
+        span.set_tags({
+            "session_id": session_id[:8],
+            "message_length": len(user_message),
+            "message_count": message_count
+        })
     
     crisis_analysis = None  # SAFE INITIALIZATION
-    crisis_detected = False
     
     try:
-        # Crisis detection BEFORE LLM call
-        crisis_analysis = crisis_detector.analyze_message(
-            user_message, 
-            session["messages"]
-        )
-        
-        # SAFE Datadog tags (after crisis_analysis exists)
-        if span and crisis_analysis:
-            span.set_tag("service", "mental-health-bot")
-            span.set_tag("env", "production")
-            span.set_tag("crisis.score", crisis_analysis['crisis_score'])
-            span.set_tag("risk_level", crisis_analysis['risk_level'])
-            span.set_tag("llm.model", "gemini-2.0-flash-lite-001")
-        
-        # Log crisis metrics
-        logger.info('crisis.score', crisis_analysis['crisis_score'] if crisis_analysis else 0)
-        logger.info('crisis.risk_level', crisis_analysis['risk_level_numeric'] if crisis_analysis else 1)
+        crisis_analysis = await _detect_crisis(state, user_message, recent, message_count)
+        _tag_crisis(span, crisis_analysis)
         
         # Generate response using Vertex AI
         llm_start = time.time()
-        llm_response = await vertex_client.generate_response(
-            user_message=user_message,
-            conversation_history=session["messages"],
-            crisis_context=crisis_analysis
-        )
-        llm_latency = time.time() - llm_start
-        
-        # Record LLM metrics
-        logger.info('llm.latency', llm_latency * 1000)
-        logger.info('llm.requests')
-        logger.info('llm.tokens.input', llm_response.get('input_tokens', 0))
-        logger.info('llm.tokens.output', llm_response.get('output_tokens', 0))
-        logger.info('llm.cost', llm_response.get('estimated_cost', 0))
-        
-        # Update session
-        session["messages"].append({
-            "role": "user",
-            "content": user_message,
-            "timestamp": datetime.now().isoformat()
-        })
-        session["messages"].append({
-            "role": "assistant",
-            "content": llm_response['text'],
-            "timestamp": datetime.now().isoformat()
-        })
-        if crisis_analysis:
-            session["crisis_scores"].append(crisis_analysis['crisis_score'])
-        session["total_tokens"] += llm_response.get('total_tokens', 0)
-        session["total_cost"] += llm_response.get('estimated_cost', 0)
-        
-        # Create Datadog event if HIGH risk
-        if crisis_analysis and crisis_analysis['risk_level'] == 'HIGH':
-            dd_telemetry.create_crisis_event(
-                session_id=session_id,
-                crisis_analysis=crisis_analysis,
+        cache_key = _llm_cache_key(user_message, crisis_analysis['risk_level'], recent)
+        cached = await state.session_store.get_llm_response(cache_key) if cache_key else None
+        if cached is not None:
+            llm_response = _cached_llm_response(cached)
+        else:
+            llm_response = await state.llm_batcher.generate(
+                dedup_key=cache_key,
                 user_message=user_message,
-                session_context=session
+                conversation_history=recent,
+                crisis_context=crisis_analysis
             )
-            logger.info('crisis.high_risk_detected')
-            crisis_detected = True
-        
-        # Calculate response time
-        total_latency = time.time() - start_time
-        logger.info('request.latency', total_latency * 1000)
+            # A reply shared with a concurrent request is stored by the one that paid for it
+            if cache_key and not llm_response.get('cached') and llm_response.get('finish_reason') != 'ERROR':
+                await state.session_store.put_llm_response(cache_key, llm_response)
+        llm_latency = time.time() - llm_start
         
-        logger.info(
-            "Chat interaction processed",
-            extra={
-                "session_id": session_id,
-                "crisis_score": crisis_analysis['crisis_score'] if crisis_analysis else 0,
-                "risk_level": crisis_analysis['risk_level'] if crisis_analysis else 'UNKNOWN',
-                "llm_latency_ms": llm_latency * 1000,
-                "total_latency_ms": total_latency * 1000,
-                "tokens_used": llm_response.get('total_tokens', 0)
-            }
+        crisis_detected = await _record_turn(
+            state, session_id, session, user_message, crisis_analysis,
+            llm_response, llm_latency, start_time, span
         )
         
         return {
@@ -627,36 +504,135 @@ async def chat(message: Message):
         }
         
     except Exception as e:
-        logger.error(f"Error processing chat: {str(e)}", exc_info=True)
-        logger.info('errors.chat_processing')
+        _log_chat_error(e)
         if span:
-            span.set_tag("error", True)
-            span.set_tag("error.message", str(e))
+            span.set_tags({"error": True, "error.message": str(e), MANUAL_KEEP_KEY: True})
         
         # SAFE fallback response
         return {
             "session_id": session_id,
-            "response": "I'm having trouble processing your message right now, but I'm here to listen. Could you try rephrasing?",
+            "response": CHAT_ERROR_RESPONSE,
             "crisis_detected": False,
             "risk_level": "UNKNOWN",
             "crisis_resources": []
         }
 
+@app.post("/chat/stream")
+@tracer.wrap(service="mental-health-bot", resource="chat_stream")
+async def chat_stream(message: Message, request: Request):
+    """
+    Handle chat messages, streaming the reply as Server-Sent Events.
+    Sends one `meta` event (session and crisis info), `token` events as the
+    reply is generated, then `done`.
+    """
+    
+    start_time = time.time()
+    state = request.app.state
+    session_id = message.session_id or secrets.token_hex(8)
+    user_message = message.user_message.strip()
+    
+    meta = {
+        "session_id": session_id,
+        "crisis_detected": False,
+        "risk_level": "LOW",
+        "crisis_resources": []
+    }
+    
+    # Nothing to analyze or answer (empty / single character) - skip detection and the LLM
+    if len(user_message) < 2:
+        frames = [_sse("meta", meta), _sse("token", {"text": TRIVIAL_MESSAGE_RESPONSE}), _sse("done", {})]
+        return StreamingResponse(iter(frames), media_type="text/event-stream", headers=SSE_HEADERS)
+    
+    # Initialize session if new
+    session, created = await state.session_store.get_or_create(session_id)
+    if created:
+        logger.info('sessions.created')
+    
+    recent = recent_messages(session, MAX_HISTORY_MESSAGES)
+    message_count = session["message_count"]
+    
+    span = tracer.current_span()
+    if span:
+        span.set_tags({
+            "session_id": session_id[:8],
+            "message_length": len(user_message),
+            "message_count": message_count
+        })
+    
+    # Detection finishes before the first byte, so the client learns the risk
+    # level (and any crisis resources) ahead of the reply text
+    try:
+        crisis_analysis = await _detect_crisis(state, user_message, recent, message_count)
+    except Exception as e:
+        _log_chat_error(e)
+        if span:
+            span.set_tags({"error": True, "error.message": str(e), MANUAL_KEEP_KEY: True})
+        meta["risk_level"] = "UNKNOWN"
+        frames = [_sse("meta", meta), _sse("token", {"text": CHAT_ERROR_RESPONSE}), _sse("done", {})]
+        return StreamingResponse(iter(frames), media_type="text/event-stream", headers=SSE_HEADERS)
+    
+    _tag_crisis(span, crisis_analysis)
+    high_risk = crisis_analysis['risk_level'] == 'HIGH'
+    if high_risk and span:
+        # The request span closes when streaming starts, so keep it now
+        span.set_tag(MANUAL_KEEP_KEY)
+    meta.update({
+        "crisis_detected": high_risk,
+        "risk_level": crisis_analysis['risk_level'],
+        "crisis_resources": crisis_analysis.get('resources', []) if high_risk else []
+    })
+    
+    async def events():
+        yield _sse("meta", meta)
+        llm_response = None
+        # The request span has already closed by the time the body streams,
+        # so generation and the turn bookkeeping get a span of their own
+        with tracer.trace("chat.stream", service="mental-health-bot", resource="chat_stream") as stream_span:
+            stream_span.set_tag("session_id", session_id[:8])
+            try:
+                llm_start = time.time()
+                cache_key = _llm_cache_key(user_message, crisis_analysis['risk_level'], recent)
+                cached = await state.session_store.get_llm_response(cache_key) if cache_key else None
+                if cached is not None:
+                    llm_response = _cached_llm_response(cached)
+                    yield _sse("token", {"text": llm_response['text']})
+                else:
+                    # Streaming calls go straight to Vertex; the batcher only
+                    # returns whole replies
+                    async for chunk in state.vertex_client.generate_response_stream(
+                        user_message=user_message,
+                        conversation_history=recent,
+                        crisis_context=crisis_analysis
+                    ):
+                        if chunk.get('done'):
+                            llm_response = chunk
+                        else:
+                            yield _sse("token", chunk)
+                    if llm_response is None:
+                        raise RuntimeError("LLM stream ended without a final chunk")
+                    if cache_key and llm_response.get('finish_reason') != 'ERROR':
+                        await state.session_store.put_llm_response(cache_key, llm_response)
+                llm_latency = time.time() - llm_start
+                
+                await _record_turn(
+                    state, session_id, session, user_message, crisis_analysis,
+                    llm_response, llm_latency, start_time, stream_span
+                )
+            except Exception as e:
+                _log_chat_error(e)
+                stream_span.set_tags({"error": True, "error.message": str(e), MANUAL_KEEP_KEY: True})
+                yield _sse("error", {"text": CHAT_ERROR_RESPONSE})
+        yield _sse("done", {})
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 
 @app.get("/metrics")
-async def get_metrics():
+async def get_metrics(request: Request):
     """Endpoint for health checks and metrics"""
-    total_sessions = len(sessions)
-    high_risk_sessions = sum(
-        1 for s in sessions.values() 
-        if s['crisis_scores'] and max(s['crisis_scores']) > 0.7
-    )
-    
     return {
         "status": "healthy",
-        "total_sessions": total_sessions,
-        "high_risk_sessions": high_risk_sessions,
-        "avg_session_length": sum(len(s['messages']) for s in sessions.values()) / max(total_sessions, 1)
+        **(await request.app.state.session_store.metrics())
     }
 
 @app.get("/health")
@@ -666,4 +642,14 @@ async def health_check():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
+    # Workers only share sessions through Redis, so stay single-process without it
+    default_workers = (os.cpu_count() or 1) * 2 + 1 if os.environ.get('REDIS_URL') else 1
+    workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
@@ -0,0 +1,356 @@
+"""
+Session Store Module
+Conversation state kept in process memory, or in Redis when REDIS_URL is set
+"""
+
+import os
+import asyncio
+import heapq
+import resource
+import orjson
+import logging
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Messages kept in the live session; older turns never reach the detector or the LLM
+HISTORY_WINDOW = int(os.environ.get('SESSION_HISTORY_WINDOW', 24))
+
+# A session counts as high risk once any turn scores above this
+HIGH_RISK_THRESHOLD = 0.7
+
+# How often the in-memory store checks process memory, and the share of the
+# limit at which it starts shedding sessions
+MEMORY_CHECK_INTERVAL_SECONDS = 30
+MEMORY_PRESSURE_RATIO = 0.9
+
+# How long a generated LLM reply may be reused for an identical prompt
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 3600))
+
+
+def _current_rss_bytes() -> int:
+    """Resident set size now; falls back to the peak where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _session_size(session: Dict) -> int:
+    return sum(len(m.get('content', '')) for m in session["messages"])
+
+
+def _parse_created_at(raw: bytes) -> float:
+    # Sessions written before created_at became epoch seconds hold an ISO string
+    try:
+        return float(raw)
+    except ValueError:
+        return datetime.fromisoformat(raw.decode()).timestamp()
+
+
+def recent_messages(session: Dict, limit: int) -> List[Dict]:
+    """The last `limit` messages of a session, oldest first"""
+    messages = session["messages"]
+    return list(islice(messages, max(len(messages) - limit, 0), None))
+
+
+def _new_session() -> Dict:
+    return {
+        "messages": deque(maxlen=HISTORY_WINDOW),
+        "message_count": 0,
+        "created_at": time.time(),
+        "max_crisis_score": 0.0,
+        "total_tokens": 0,
+        "total_cost": 0.0
+    }
+
+
+def _apply_turn(session: Dict, new_messages: List[Dict], crisis_score: float, tokens: int, cost: float):
+    # The deque is bounded, so the oldest turns fall off on their own
+    session["messages"].extend(new_messages)
+    session["message_count"] += len(new_messages)
+    # Only the peak is ever read, so per-turn scores aren't kept
+    session["max_crisis_score"] = max(session["max_crisis_score"], crisis_score)
+    session["total_tokens"] += tokens
+    session["total_cost"] += cost
+
+
+class InMemorySessionStore:
+    """
+    Sessions in a process-local dict (single worker, lost on restart).
+    Kept in least-recently-used order, so idle sessions expire from the front
+    and the oldest is dropped once max_sessions is reached. With a memory limit
+    set, a background check also sheds the largest sessions under memory pressure.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 10000,
+        ttl_seconds: int = 3600,
+        memory_limit_bytes: Optional[int] = None,
+        llm_cache_size: int = 1024
+    ):
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.memory_limit_bytes = memory_limit_bytes
+        self._watchdog: Optional[asyncio.Task] = None
+        # Running aggregates so /metrics never walks the sessions
+        self.total_messages = 0
+        self.high_risk_ids = set()
+        self.llm_cache = OrderedDict()
+        self.llm_cache_size = llm_cache_size
+
+    async def get_or_create(self, session_id: str) -> Tuple[Dict, bool]:
+        """Return (session, created) for session_id"""
+        now = time.monotonic()
+        self._expire(now)
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session["last_seen"] = now
+            self.sessions.move_to_end(session_id)
+            return session, False
+        if len(self.sessions) >= self.max_sessions:
+            self._evict(next(iter(self.sessions)))
+        session = self.sessions[session_id] = _new_session()
+        session["last_seen"] = now
+        return session, True
+
+    def _expire(self, now: float):
+        cutoff = now - self.ttl_seconds
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session["last_seen"] >= cutoff:
+                break
+            self._evict(session_id)
+
+    def _evict(self, session_id: str):
+        session = self.sessions.pop(session_id)
+        self.total_messages -= session["message_count"]
+        self.high_risk_ids.discard(session_id)
+
+    def start(self):
+        """Start the memory watchdog when a limit is configured"""
+        if self.memory_limit_bytes:
+            self._watchdog = asyncio.create_task(self._watch_memory())
+
+    async def stop(self):
+        if self._watchdog:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    async def _watch_memory(self):
+        threshold = self.memory_limit_bytes * MEMORY_PRESSURE_RATIO
+        while True:
+            await asyncio.sleep(MEMORY_CHECK_INTERVAL_SECONDS)
+            now = time.monotonic()
+            self._expire(now)
+            rss = _current_rss_bytes()
+            if rss < threshold or not self.sessions:
+                continue
+            # Largest conversations go first; they free the most per eviction
+            count = max(1, len(self.sessions) // 10)
+            for session_id in heapq.nlargest(count, self.sessions, key=lambda sid: _session_size(self.sessions[sid])):
+                self._evict(session_id)
+            logger.warning(f"Memory pressure ({rss / 2**20:.0f}MB RSS): evicted {count} sessions")
+
+    async def save_turn(
+        self,
+        session_id: str,
+        session: Dict,
+        new_messages: List[Dict],
+        crisis_score: float,
+        tokens: int,
+        cost: float
+    ):
+        """Record one user/assistant exchange"""
+        _apply_turn(session, new_messages, crisis_score, tokens, cost)
+        if self.sessions.get(session_id) is not session:
+            return  # evicted while the request was in flight
+        self.total_messages += len(new_messages)
+        if crisis_score > HIGH_RISK_THRESHOLD:
+            self.high_risk_ids.add(session_id)
+
+    async def metrics(self) -> Dict:
+        """Aggregate numbers for the /metrics endpoint"""
+        total_sessions = len(self.sessions)
+        return {
+            "total_sessions": total_sessions,
+            "high_risk_sessions": len(self.high_risk_ids),
+            "avg_session_length": self.total_messages / max(total_sessions, 1)
+        }
+
+    async def get_llm_response(self, key: str) -> Optional[Dict]:
+        """Cached LLM reply for key, if still fresh"""
+        entry = self.llm_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del self.llm_cache[key]
+            return None
+        return response
+
+    async def put_llm_response(self, key: str, response: Dict):
+        """Cache an LLM reply, dropping the oldest entry when full"""
+        self.llm_cache[key] = (time.monotonic() + LLM_CACHE_TTL_SECONDS, response)
+        self.llm_cache.move_to_end(key)
+        if len(self.llm_cache) > self.llm_cache_size:
+            self.llm_cache.popitem(last=False)
+
+
+class RedisSessionStore:
+    """
+    Sessions shared through Redis so every worker sees the same state.
+
+    sess:{sid}         hash   created_at (epoch seconds), message_count,
+                              max_crisis_score, total_tokens, total_cost
+    sess:{sid}:msgs    list   JSON-encoded messages, last HISTORY_WINDOW only
+    sess:{sid}:history list   full JSON-encoded history, append-only for audit
+    stats:sessions     string sessions created
+    stats:messages     string messages stored
+    stats:high_risk    set    ids of sessions that crossed HIGH_RISK_THRESHOLD
+
+    The stats:* keys are cumulative; they do not shrink when sessions expire.
+
+    Recently used sessions are also kept in a local LRU. A local copy is reused
+    while its message_count still matches Redis, so a hit costs one HGET
+    instead of reloading the history; a turn handled by another worker or
+    instance changes the count and forces a reload.
+    """
+
+    def __init__(self, url: str, ttl_seconds: int, local_size: int = 1000):
+        # Imported here so the in-memory deployment doesn't need the package
+        import redis.asyncio as aioredis
+
+        self.redis = aioredis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.local = OrderedDict()
+        self.local_size = local_size
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        await self.redis.aclose()
+
+    async def get_or_create(self, session_id: str) -> Tuple[Dict, bool]:
+        """Return (session, created) for session_id"""
+        key = f"sess:{session_id}"
+        session = self.local.get(session_id)
+        if session is not None:
+            count = await self.redis.hget(key, "message_count")
+            if count is not None and int(count) == session["message_count"]:
+                self.local.move_to_end(session_id)
+                return session, False
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(key)
+            pipe.lrange(f"{key}:msgs", 0, -1)
+            fields, raw_messages = await pipe.execute()
+
+        if not fields:
+            session = _new_session()
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hset(key, mapping={
+                    "created_at": session["created_at"],
+                    "message_count": 0,
+                    "max_crisis_score": 0.0,
+                    "total_tokens": 0,
+                    "total_cost": 0.0
+                })
+                pipe.expire(key, self.ttl_seconds)
+                pipe.incr("stats:sessions")
+                await pipe.execute()
+            self._remember(session_id, session)
+            return session, True
+
+        session = {
+            "messages": deque((orjson.loads(m) for m in raw_messages), maxlen=HISTORY_WINDOW),
+            "message_count": int(fields.get(b"message_count", 0)),
+            "created_at": _parse_created_at(fields[b"created_at"]),
+            "max_crisis_score": float(fields.get(b"max_crisis_score", 0.0)),
+            "total_tokens": int(fields[b"total_tokens"]),
+            "total_cost": float(fields[b"total_cost"])
+        }
+        self._remember(session_id, session)
+        return session, False
+
+    def _remember(self, session_id: str, session: Dict):
+        self.local[session_id] = session
+        self.local.move_to_end(session_id)
+        if len(self.local) > self.local_size:
+            self.local.popitem(last=False)
+
+    async def save_turn(
+        self,
+        session_id: str,
+        session: Dict,
+        new_messages: List[Dict],
+        crisis_score: float,
+        tokens: int,
+        cost: float
+    ):
+        """Record one user/assistant exchange"""
+        key = f"sess:{session_id}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            encoded = [orjson.dumps(m) for m in new_messages]
+            pipe.rpush(f"{key}:msgs", *encoded)
+            pipe.ltrim(f"{key}:msgs", -HISTORY_WINDOW, -1)
+            pipe.rpush(f"{key}:history", *encoded)
+            if crisis_score > session["max_crisis_score"]:
+                pipe.hset(key, "max_crisis_score", crisis_score)
+            pipe.hincrby(key, "message_count", len(new_messages))
+            pipe.hincrby(key, "total_tokens", tokens)
+            pipe.hincrbyfloat(key, "total_cost", cost)
+            for k in (key, f"{key}:msgs", f"{key}:history"):
+                pipe.expire(k, self.ttl_seconds)
+            pipe.incrby("stats:messages", len(new_messages))
+            if crisis_score > HIGH_RISK_THRESHOLD:
+                pipe.sadd("stats:high_risk", session_id)
+            await pipe.execute()
+
+        _apply_turn(session, new_messages, crisis_score, tokens, cost)
+
+    async def metrics(self) -> Dict:
+        """Aggregate numbers for the /metrics endpoint"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get("stats:sessions")
+            pipe.get("stats:messages")
+            pipe.scard("stats:high_risk")
+            total_sessions, total_messages, high_risk_sessions = await pipe.execute()
+        total_sessions = int(total_sessions or 0)
+        total_messages = int(total_messages or 0)
+        return {
+            "total_sessions": total_sessions,
+            "high_risk_sessions": high_risk_sessions,
+            "avg_session_length": total_messages / max(total_sessions, 1)
+        }
+
+    async def get_llm_response(self, key: str) -> Optional[Dict]:
+        """Cached LLM reply for key, if still fresh"""
+        cached = await self.redis.get(f"llm:{key}")
+        return orjson.loads(cached) if cached is not None else None
+
+    async def put_llm_response(self, key: str, response: Dict):
+        """Cache an LLM reply; Redis expires it"""
+        await self.redis.setex(f"llm:{key}", LLM_CACHE_TTL_SECONDS, orjson.dumps(response))
+
+
+def create_session_store():
+    """Use Redis when REDIS_URL is configured, otherwise keep sessions in memory"""
+    redis_url = os.environ.get('REDIS_URL')
+    ttl_seconds = int(os.environ.get('SESSION_TTL_SECONDS', 3600))
+    if redis_url:
+        logger.info("Session store: Redis")
+        return RedisSessionStore(redis_url, ttl_seconds)
+    max_sessions = int(os.environ.get('MAX_SESSIONS', 10000))
+    memory_limit_mb = os.environ.get('MEMORY_LIMIT_MB')
+    memory_limit_bytes = int(memory_limit_mb) * 2**20 if memory_limit_mb else None
+    logger.info(f"Session store: in-memory (max {max_sessions} sessions)")
+    return InMemorySessionStore(max_sessions, ttl_seconds, memory_limit_bytes)
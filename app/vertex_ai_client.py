@@ -4,32 +4,172 @@ Handles LLM interactions with safety controls and cost tracking
 """
 
 import os
+import asyncio
 import logging
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 import time
-import json
 import re
+import random
+import threading
+from collections import OrderedDict
 
 # Vertex AI imports
+from google.api_core.exceptions import ResourceExhausted
 from google.cloud import aiplatform
-from vertexai.generative_models import GenerativeModel, GenerationConfig
+from vertexai.generative_models import GenerativeModel, GenerationConfig, Content, Part
 from vertexai.generative_models import SafetySetting, HarmCategory, HarmBlockThreshold
 
 logger = logging.getLogger(__name__)
 
+# The system instruction is the same for every request, so Gemini's implicit
+# prompt cache can reuse it (and the committed history after it) across turns.
+# Per-turn crisis guidance goes at the end of the user turn instead.
+BASE_INSTRUCTION = """You are a compassionate mental health support assistant for India. Your role is to:
+1. Listen empathetically and validate feelings
+2. Provide brief, focused responses (2-3 paragraphs maximum)
+3. Use natural, conversational language - not lists or bullet points
+4. Never provide medical advice or diagnoses
+5. Encourage professional help when appropriate
+6. Maintain a supportive, non-judgmental tone
+7. Be honest about your limitations as an AI
+
+IMPORTANT FORMATTING RULES:
+- Keep responses concise (under 150 words)
+- Use short paragraphs (2-3 sentences each)
+- No bullet points or numbered lists
+- Natural conversation flow
+- One question per response maximum"""
+
+HIGH_SUFFIX = """CRISIS MODE - CRITICAL:
+This person may be in immediate danger. FIRST SENTENCE MUST BE: "I'm really concerned. Please call helpline NOW: Kiran 1800-599-0019 or Sneha 044-24640050 (24/7)" and 
+Your response MUST:
+1. Acknowledge their pain with empathy
+2. Immediately provide crisis resources in your first paragraph:
+"I'm deeply concerned about your safety. Please reach out for immediate help:
+• Call or text 988 (Suicide & Crisis Lifeline) - available 24/7
+• Text HOME to 741741 (Crisis Text Line)
+These counselors are trained to help and want to support you."
+3. Encourage staying connected
+4. Express genuine care
+5. DO NOT end the conversation abruptly
+6. Keep your full response under 100 words
+
+Example structure:
+"I hear that you're in tremendous pain right now, and I'm truly concerned about your safety. [Crisis resources]. You don't have to face this alone. Would you be willing to reach out to one of these services? I'm here with you right now."
+"""
+
+MEDIUM_SUFFIX = """ELEVATED CONCERN MODE:
+This person is showing signs of significant distress. Your response should:
+1. Validate their feelings with empathy
+2. Gently explore their support system
+3. Suggest professional resources if appropriate (therapist, counselor)
+4. Stay engaged and supportive
+5. Keep response focused and under 120 words
+
+Example: "I can hear that you're going through a really difficult time. That kind of pain is real and valid. Have you been able to talk with anyone about how you're feeling? Sometimes having support - whether from friends, family, or a professional - can make things feel a little more manageable. I'm here to listen if you'd like to talk more about what's been going on."
+"""
+
+_CRISIS_HINTS = {'HIGH': HIGH_SUFFIX, 'MEDIUM': MEDIUM_SUFFIX}
+
+# Session message roles as Gemini names them
+_ROLE_MAP = {'user': 'user', 'assistant': 'model'}
+
+# History turns wrapped as Content, kept per client and reused across requests
+CONTENT_CACHE_SIZE = 512
+
+# Safe replies when generation fails
+_FALLBACK_HIGH = """Technical issue - EMERGENCY: Call Kiran Mental Health Helpline 1800-599-0019 or Sneha Foundation 044-24640050 NOW (24/7). You're not alone.
+        
+Please reach out to:
+- 988 Suicide & Crisis Lifeline (call or text 988)
+- Crisis Text Line (text HOME to 741741)
+
+You don't have to go through this alone. These trained counselors are available 24/7 and want to help."""
+
+_FALLBACK_DEFAULT = """I'm having trouble processing your message right now, but I'm here to listen. 
+Could you try rephrasing what you'd like to talk about?"""
+
+# Retries for 429s from the shared pay-as-you-go pool. Backoff doubles per
+# attempt with jitter; HIGH risk turns get one extra attempt before falling
+# back to the canned crisis reply.
+RATE_LIMIT_RETRIES = int(os.environ.get('VERTEX_RATE_LIMIT_RETRIES', 2))
+RATE_LIMIT_BACKOFF_SECONDS = 0.25
+
+# Output token ceiling per risk level. The prompts ask for 100-150 words
+# (~130-200 tokens); the ceiling only bites when a reply would ramble, and
+# decode time grows with every token generated.
+MAX_OUTPUT_TOKENS = {'LOW': 340, 'MEDIUM': 260, 'HIGH': 220}
+
+MODEL_NAME = "gemini-2.0-flash-lite-001"
+
+# Safety settings
+_SAFETY_SETTINGS = [
+    SafetySetting(
+        category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        threshold=HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    ),
+    SafetySetting(
+        category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+        threshold=HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    ),
+    SafetySetting(
+        category=HarmCategory.HARM_CATEGORY_HARASSMENT,
+        threshold=HarmBlockThreshold.BLOCK_ONLY_HIGH
+    ),
+    SafetySetting(
+        category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+        threshold=HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    ),
+]
+
+# Generation config, one per risk level for its output ceiling
+_GENERATION_CONFIGS = {
+    level: GenerationConfig(
+        temperature=0.8,
+        top_p=0.9,
+        top_k=40,
+        max_output_tokens=max_tokens,
+    )
+    for level, max_tokens in MAX_OUTPUT_TOKENS.items()
+}
+
+# Vertex AI init and the models are process-wide and shared by every
+# VertexAIClient. They are built on first use rather than at import, so a
+# preloading gunicorn master never initializes Vertex before forking.
+_MODELS: Optional[Dict[str, GenerativeModel]] = None
+_MODELS_LOCK = threading.Lock()
+
+
+def _get_models() -> Dict[str, GenerativeModel]:
+    global _MODELS
+    if _MODELS is None:
+        with _MODELS_LOCK:
+            if _MODELS is None:
+                project_id = os.environ.get('GOOGLE_CLOUD_PROJECT', 'mental-health-monitor-482612')
+                location = os.environ.get('GOOGLE_CLOUD_LOCATION', 'us-central1')
+                aiplatform.init(project=project_id, location=location)
+                
+                # One model per risk level, with config and safety settings
+                # bound. All share BASE_INSTRUCTION so the cacheable prompt
+                # prefix is the same whichever one serves a turn.
+                _MODELS = {
+                    level: GenerativeModel(
+                        MODEL_NAME,
+                        system_instruction=BASE_INSTRUCTION,
+                        generation_config=config,
+                        safety_settings=_SAFETY_SETTINGS
+                    )
+                    for level, config in _GENERATION_CONFIGS.items()
+                }
+    return _MODELS
+
+
 class VertexAIClient:
     """Client for Vertex AI Gemini models with observability"""
     
     def __init__(self):
-        # Initialize Vertex AI
-        project_id = os.environ.get('GOOGLE_CLOUD_PROJECT', 'mental-health-monitor-482612')
-        location = os.environ.get('GOOGLE_CLOUD_LOCATION', 'us-central1')
-        
-        aiplatform.init(project=project_id, location=location)
-        
         # Use Gemini 2.0 Flash Lite
-        self.model_name = "gemini-2.0-flash-lite-001"
-        self.model = GenerativeModel(self.model_name)
+        self.model_name = MODEL_NAME
         
         # Pricing (approximate, as of Dec 2024)
         self.pricing = {
@@ -37,40 +177,16 @@ class VertexAIClient:
             'output_per_1k_tokens': 0.000075    # $0.075 per 1M tokens
         }
         
-        # Safety settings
-        self.safety_settings = [
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                threshold=HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                threshold=HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_HARASSMENT,
-                threshold=HarmBlockThreshold.BLOCK_ONLY_HIGH
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                threshold=HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-            ),
-        ]
+        # Models picked per request by risk level
+        self.models = _get_models()
         
-        # Generation config
-        self.generation_config = GenerationConfig(
-            temperature=0.8,
-            top_p=0.9,
-            top_k=40,
-            max_output_tokens=1004,
-        )
+        # (role, text) -> Content for recent history turns, least recently used first
+        self._content_cache: OrderedDict = OrderedDict()
         
-        logger.info(f"Vertex AI client initialized with model: {self.model_name}")
+        logger.info("Vertex AI client initialized with model: %s", self.model_name)
     
     def _strip_markdown(self, text: str) -> str:
         """Remove ALL markdown + convert bullets to clean text"""
-        import re
-        
         # Remove **bold** and *italic*
         text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
         text = re.sub(r'\*(.*?)\*', r'\1', text)
@@ -102,20 +218,13 @@ class VertexAIClient:
         start_time = time.time()
         
         try:
-            # Build system instruction based on crisis level
-            system_instruction = self._build_system_instruction(crisis_context)
-            
             # Format conversation history for Gemini
             chat_history = self._format_history(conversation_history)
             
-            # Create chat session
-            chat = self.model.start_chat(history=chat_history)
-            
-            # Generate response
-            response = chat.send_message(
-                user_message,
-                generation_config=self.generation_config,
-                safety_settings=self.safety_settings,
+            # Generate response; the history plus this turn is the whole request
+            response = await self._generate(
+                crisis_context,
+                chat_history + [self._user_content(user_message, crisis_context)],
                 stream=False
             )
             
@@ -126,32 +235,14 @@ class VertexAIClient:
             text = self._strip_markdown(text)
             
             # Extract usage metadata
-            usage_metadata = response.usage_metadata if hasattr(response, 'usage_metadata') else None
-            
-            input_tokens = usage_metadata.prompt_token_count if usage_metadata else self._estimate_tokens(user_message + str(chat_history))
-            output_tokens = usage_metadata.candidates_token_count if usage_metadata else self._estimate_tokens(text)
+            input_tokens, output_tokens = self._token_counts(response, user_message, conversation_history, text)
             total_tokens = input_tokens + output_tokens
             
             # Calculate cost
-            estimated_cost = (
-                (input_tokens / 1000) * self.pricing['input_per_1k_tokens'] +
-                (output_tokens / 1000) * self.pricing['output_per_1k_tokens']
-            )
+            estimated_cost = self._estimate_cost(input_tokens, output_tokens)
             
-            # Extract safety ratings
-            safety_ratings = {}
-            if hasattr(response, 'candidates') and response.candidates:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'safety_ratings'):
-                    for rating in candidate.safety_ratings:
-                        safety_ratings[rating.category.name] = rating.probability.name
-            
-            # Get finish reason
-            finish_reason = "STOP"
-            if hasattr(response, 'candidates') and response.candidates:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'finish_reason'):
-                    finish_reason = candidate.finish_reason.name
+            # Extract safety ratings and finish reason
+            safety_ratings, finish_reason = self._response_details(response)
             
             result = {
                 'text': text,
@@ -166,14 +257,14 @@ class VertexAIClient:
             }
             
             logger.info(
-                f"LLM response generated: {total_tokens} tokens, "
-                f"${estimated_cost:.6f} cost, {latency_ms:.2f}ms latency"
+                "LLM response generated: %d tokens, $%.6f cost, %.2fms latency",
+                total_tokens, estimated_cost, latency_ms
             )
             
             return result
             
         except Exception as e:
-            logger.error(f"Error generating response: {str(e)}", exc_info=True)
+            logger.error("Error generating response: %s", e, exc_info=True)
             
             # Return safe fallback response
             return {
@@ -189,100 +280,201 @@ class VertexAIClient:
                 'model': self.model_name
             }
     
-    def _build_system_instruction(self, crisis_context: Optional[Dict]) -> str:
-        """Build context-aware system instruction"""
-        
-        base_instruction = """You are a compassionate mental health support assistant for India. Your role is to:
-1. Listen empathetically and validate feelings
-2. Provide brief, focused responses (2-3 paragraphs maximum)
-3. Use natural, conversational language - not lists or bullet points
-4. Never provide medical advice or diagnoses
-5. Encourage professional help when appropriate
-6. Maintain a supportive, non-judgmental tone
-7. Be honest about your limitations as an AI
-
-IMPORTANT FORMATTING RULES:
-- Keep responses concise (under 150 words)
-- Use short paragraphs (2-3 sentences each)
-- No bullet points or numbered lists
-- Natural conversation flow
-- One question per response maximum"""
-
-        if not crisis_context:
-            return base_instruction
-        
-        risk_level = crisis_context.get('risk_level', 'LOW')
+    async def generate_response_stream(
+        self,
+        user_message: str,
+        conversation_history: List[Dict],
+        crisis_context: Optional[Dict] = None
+    ) -> AsyncIterator[Dict]:
+        """
+        Stream a response as Gemini generates it.
+        Yields {'text': ...} for each finished paragraph, then one final dict shaped
+        like generate_response's result (full text, usage, cost) with 'done': True.
+        """
+        start_time = time.time()
+        parts = []
         
-        if risk_level == 'HIGH':
-            return base_instruction + """
+        try:
+            chat_history = self._format_history(conversation_history)
             
-CRISIS MODE - CRITICAL:
-This person may be in immediate danger. FIRST SENTENCE MUST BE: "I'm really concerned. Please call helpline NOW: Kiran 1800-599-0019 or Sneha 044-24640050 (24/7)" and 
-Your response MUST:
-1. Acknowledge their pain with empathy
-2. Immediately provide crisis resources in your first paragraph:
-"I'm deeply concerned about your safety. Please reach out for immediate help:
-• Call or text 988 (Suicide & Crisis Lifeline) - available 24/7
-• Text HOME to 741741 (Crisis Text Line)
-These counselors are trained to help and want to support you."
-3. Encourage staying connected
-4. Express genuine care
-5. DO NOT end the conversation abruptly
-6. Keep your full response under 100 words
-
-Example structure:
-"I hear that you're in tremendous pain right now, and I'm truly concerned about your safety. [Crisis resources]. You don't have to face this alone. Would you be willing to reach out to one of these services? I'm here with you right now."
-"""
-        elif risk_level == 'MEDIUM':
-            return base_instruction + """
+            stream = await self._generate(
+                crisis_context,
+                chat_history + [self._user_content(user_message, crisis_context)],
+                stream=True
+            )
             
-ELEVATED CONCERN MODE:
-This person is showing signs of significant distress. Your response should:
-1. Validate their feelings with empathy
-2. Gently explore their support system
-3. Suggest professional resources if appropriate (therapist, counselor)
-4. Stay engaged and supportive
-5. Keep response focused and under 120 words
-
-Example: "I can hear that you're going through a really difficult time. That kind of pain is real and valid. Have you been able to talk with anyone about how you're feeling? Sometimes having support - whether from friends, family, or a professional - can make things feel a little more manageable. I'm here to listen if you'd like to talk more about what's been going on."
-"""
-        
-        return base_instruction
+            # Markdown is stripped per paragraph, so only complete ones go out
+            pending = ''
+            response = None
+            async for response in stream:
+                pending += response.text
+                cut = pending.rfind('\n\n')
+                if cut == -1:
+                    continue
+                for paragraph in pending[:cut].split('\n\n'):
+                    paragraph = self._strip_markdown(paragraph)
+                    if paragraph:
+                        chunk = ('\n\n' if parts else '') + paragraph
+                        parts.append(chunk)
+                        yield {'text': chunk}
+                pending = pending[cut + 2:]
+            
+            paragraph = self._strip_markdown(pending)
+            if paragraph:
+                chunk = ('\n\n' if parts else '') + paragraph
+                parts.append(chunk)
+                yield {'text': chunk}
+            
+            latency_ms = (time.time() - start_time) * 1000
+            text = ''.join(parts)
+            
+            # The last chunk carries usage for the whole stream
+            input_tokens, output_tokens = self._token_counts(response, user_message, conversation_history, text)
+            total_tokens = input_tokens + output_tokens
+            estimated_cost = self._estimate_cost(input_tokens, output_tokens)
+            safety_ratings, finish_reason = self._response_details(response)
+            
+            logger.info(
+                "LLM response streamed: %d tokens, $%.6f cost, %.2fms latency",
+                total_tokens, estimated_cost, latency_ms
+            )
+            
+            yield {
+                'done': True,
+                'text': text,
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'total_tokens': total_tokens,
+                'estimated_cost': estimated_cost,
+                'latency_ms': latency_ms,
+                'safety_ratings': safety_ratings,
+                'finish_reason': finish_reason,
+                'model': self.model_name
+            }
+            
+        except Exception as e:
+            logger.error("Error streaming response: %s", e, exc_info=True)
+            
+            # Fall back only if nothing reached the client yet; otherwise end
+            # the stream with what was already sent
+            fallback = '' if parts else self._get_fallback_response(crisis_context)
+            if fallback:
+                yield {'text': fallback}
+            yield {
+                'done': True,
+                'text': ''.join(parts) or fallback,
+                'input_tokens': 0,
+                'output_tokens': 0,
+                'total_tokens': 0,
+                'estimated_cost': 0.0,
+                'latency_ms': (time.time() - start_time) * 1000,
+                'safety_ratings': {},
+                'finish_reason': 'ERROR',
+                'error': str(e),
+                'model': self.model_name
+            }
+    
+    def _estimate_cost(self, input_tokens: int, output_tokens: int) -> float:
+        """Dollar cost of one call at the model's per-1k token pricing"""
+        return (
+            (input_tokens / 1000) * self.pricing['input_per_1k_tokens'] +
+            (output_tokens / 1000) * self.pricing['output_per_1k_tokens']
+        )
+    
+    def _token_counts(self, response, user_message: str, history: List[Dict], text: str) -> Tuple[int, int]:
+        """(input, output) tokens from usage metadata, estimated when there is none"""
+        try:
+            usage_metadata = response.usage_metadata
+            return usage_metadata.prompt_token_count, usage_metadata.candidates_token_count
+        except AttributeError:
+            return self._estimate_input_tokens(user_message, history), self._estimate_tokens(text)
+    
+    def _response_details(self, response) -> Tuple[Dict, str]:
+        """Safety ratings and finish reason of the first candidate"""
+        try:
+            candidate = response.candidates[0]
+        except (AttributeError, IndexError):
+            return {}, "STOP"
+        safety_ratings = {r.category.name: r.probability.name for r in candidate.safety_ratings}
+        return safety_ratings, candidate.finish_reason.name
+    
+    async def _generate(self, crisis_context: Optional[Dict], contents: List, stream: bool):
+        """generate_content_async on the turn's model, retrying rate-limit (429) errors"""
+        model = self._model_for(crisis_context)
+        retries = RATE_LIMIT_RETRIES
+        if crisis_context and crisis_context.get('risk_level') == 'HIGH':
+            retries += 1
+        for attempt in range(retries + 1):
+            try:
+                return await model.generate_content_async(contents, stream=stream)
+            except ResourceExhausted:
+                if attempt == retries:
+                    raise
+                delay = RATE_LIMIT_BACKOFF_SECONDS * (2 ** attempt)
+                logger.warning("Vertex AI rate limited, retry %s/%s", attempt + 1, retries)
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+    
+    def _model_for(self, crisis_context: Optional[Dict]) -> GenerativeModel:
+        """Prebuilt model for the turn's risk level"""
+        risk_level = crisis_context.get('risk_level', 'LOW') if crisis_context else 'LOW'
+        return self.models.get(risk_level, self.models['LOW'])
+    
+    def _crisis_hint(self, crisis_context: Optional[Dict]) -> str:
+        """Risk-specific guidance for this turn ('' for LOW risk)"""
+        if not crisis_context:
+            return ''
+        return _CRISIS_HINTS.get(crisis_context.get('risk_level', 'LOW'), '')
+    
+    def _user_content(self, user_message: str, crisis_context: Optional[Dict]) -> Content:
+        """The user's turn, with this turn's crisis guidance appended last"""
+        hint = self._crisis_hint(crisis_context)
+        if hint:
+            user_message = f"{user_message}\n\n[Guidance for this reply - not written by the user]\n{hint}"
+        return Content(role="user", parts=[Part.from_text(user_message)])
+    
+    def _history_content(self, role: str, text: str) -> Content:
+        """
+        Content for one history turn. Session history repeats across turns, so
+        each turn is wrapped once and reused; only the newest turn is new work.
+        """
+        key = (role, text)
+        content = self._content_cache.get(key)
+        if content is not None:
+            self._content_cache.move_to_end(key)
+            return content
+        content = self._content_cache[key] = Content(role=role, parts=[Part.from_text(text)])
+        if len(self._content_cache) > CONTENT_CACHE_SIZE:
+            self._content_cache.popitem(last=False)
+        return content
     
     def _format_history(self, history: List[Dict]) -> List:
         """Format conversation history for Gemini API"""
         try:
-            from vertexai.generative_models import Content, Part
             formatted = []
             
             for msg in history[-10:]:  # Last 10 messages only
-                role = msg.get('role')
-                content = msg.get('content', '')
-                
-                if role == 'user':
-                    formatted.append(Content(role="user", parts=[Part.from_text(content)]))
-                elif role == 'assistant':
-                    formatted.append(Content(role="model", parts=[Part.from_text(content)]))
+                role = _ROLE_MAP.get(msg.get('role'))
+                if role is None:
+                    continue
+                formatted.append(self._history_content(role, msg.get('content', '')))
             
             return formatted
-        except:
+        except Exception:
             return []  # Fallback empty history
     
     def _estimate_tokens(self, text: str) -> int:
-        """Rough token estimation (1 token ≈ 4 characters for English)"""
-        return max(1, len(text) // 4)
+        """Rough token estimation (1 token ≈ 3 characters, erring high for English)"""
+        return max(1, len(text) // 3)
+    
+    def _estimate_input_tokens(self, user_message: str, history: List[Dict]) -> int:
+        """Prompt size estimate from message lengths, without rendering the history"""
+        chars = len(user_message) + sum(len(m.get('content', '')) for m in history[-10:])
+        return max(1, chars // 3)
     
     def _get_fallback_response(self, crisis_context: Optional[Dict]) -> str:
         """Safe fallback response if LLM fails"""
         
         if crisis_context and crisis_context.get('risk_level') == 'HIGH':
-            return """Technical issue - EMERGENCY: Call Kiran Mental Health Helpline 1800-599-0019 or Sneha Foundation 044-24640050 NOW (24/7). You're not alone.
+            return _FALLBACK_HIGH
         
-Please reach out to:
-- 988 Suicide & Crisis Lifeline (call or text 988)
-- Crisis Text Line (text HOME to 741741)
-
-You don't have to go through this alone. These trained counselors are available 24/7 and want to help."""
-        
-        return """I'm having trouble processing your message right now, but I'm here to listen. 
-Could you try rephrasing what you'd like to talk about?"""
+        return _FALLBACK_DEFAULT
@@ -0,0 +1,23 @@
+# === gunicorn.conf.py ===
+# Production server config: gunicorn managing uvicorn workers
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# UvicornWorker picks up uvloop and httptools from uvicorn[standard]
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# One worker per CPU, but workers only share sessions through Redis,
+# so stay single-process when sessions are kept in memory
+workers = int(os.environ.get(
+    "WEB_CONCURRENCY",
+    multiprocessing.cpu_count() if os.environ.get("REDIS_URL") else 1
+))
+
+# Import the app once in the master so workers share the loaded modules
+# copy-on-write. Clients, channels and threads are created per worker in the
+# app's lifespan handler (the log listener restarts itself after fork).
+preload_app = True
+
+accesslog = "-"
@@ -1,4 +1,6 @@
 import os
+import sys
+import asyncio
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'credentials.json'
 from app.vertex_ai_client import VertexAIClient
 
@@ -7,5 +9,11 @@ async def test():
     response = await client.generate_response("kill me", [])
     print(response)
 
-import asyncio
-asyncio.run(test())
+if __name__ == '__main__':
+    # Optional argument: number of concurrent calls (default 1)
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.gather(*(test() for _ in range(runs))))
+    finally:
+        loop.close()
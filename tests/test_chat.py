@@ -0,0 +1,166 @@
+"""
+End-to-end checks for the chat endpoints, with Vertex AI replaced by a fake client
+"""
+
+import asyncio
+import os
+
+os.environ.setdefault("DD_TRACE_ENABLED", "false")
+os.environ.pop("K_SERVICE", None)
+os.environ.pop("REDIS_URL", None)
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+
+CRISIS_MESSAGE = "I want to kill myself tonight"
+
+
+class FakeVertexClient:
+    """Stands in for VertexAIClient; replies instantly without network access"""
+
+    async def generate_response(self, user_message, conversation_history, crisis_context=None):
+        return {
+            'text': 'I hear you.',
+            'input_tokens': 1,
+            'output_tokens': 1,
+            'total_tokens': 2,
+            'estimated_cost': 0.0,
+            'latency_ms': 1.0,
+            'safety_ratings': {},
+            'finish_reason': 'STOP',
+            'model': 'fake'
+        }
+
+    async def generate_response_stream(self, **request):
+        result = await self.generate_response(**request)
+        yield {'text': result['text']}
+        yield {'done': True, **result}
+
+
+def _sse_events(body: str):
+    events = []
+    for frame in body.split("\n\n"):
+        if frame:
+            event, data = frame.split("\n", 1)
+            events.append((event[len("event: "):], data[len("data: "):]))
+    return events
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "VertexAIClient", FakeVertexClient)
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def test_chat_detects_high_risk(client):
+    response = client.post("/chat", json={"session_id": "t-chat", "user_message": CRISIS_MESSAGE})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["risk_level"] == "HIGH"
+    assert data["crisis_detected"] is True
+    assert data["crisis_resources"]
+    assert data["response"] == "I hear you."
+
+
+def test_chat_stream_detects_high_risk(client):
+    response = client.post("/chat/stream", json={"session_id": "t-stream", "user_message": CRISIS_MESSAGE})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _sse_events(response.text)
+    assert [name for name, _ in events] == ["meta", "token", "done"]
+    meta = main.orjson.loads(events[0][1])
+    assert meta["risk_level"] == "HIGH"
+    assert meta["crisis_detected"] is True
+
+
+
+def test_chat_stream_reports_generation_failure(monkeypatch):
+    class FailingVertexClient(FakeVertexClient):
+        async def generate_response_stream(self, **request):
+            raise RuntimeError("vertex unavailable")
+            yield
+
+    monkeypatch.setattr(main, "VertexAIClient", FailingVertexClient)
+    with TestClient(main.app) as client:
+        response = client.post("/chat/stream", json={"session_id": "t-fail", "user_message": "I feel a bit low today"})
+
+    assert response.status_code == 200
+    events = _sse_events(response.text)
+    assert [name for name, _ in events] == ["meta", "error", "done"]
+    assert main.orjson.loads(events[1][1])["text"] == main.CHAT_ERROR_RESPONSE
+
+def test_chat_stream_first_frame_is_not_buffered(monkeypatch):
+    """The meta frame reaches the client, uncompressed, while the reply is still generating"""
+
+    async def scenario():
+        release = asyncio.Event()
+
+        class GatedVertexClient(FakeVertexClient):
+            async def generate_response_stream(self, **request):
+                await release.wait()
+                async for chunk in super().generate_response_stream(**request):
+                    yield chunk
+
+        monkeypatch.setattr(main, "VertexAIClient", GatedVertexClient)
+        body = main.orjson.dumps({"session_id": "t-unbuffered", "user_message": CRISIS_MESSAGE})
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/chat/stream",
+            "raw_path": b"/chat/stream",
+            "root_path": "",
+            "query_string": b"",
+            "headers": [
+                (b"host", b"testserver"),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"accept-encoding", b"gzip"),
+            ],
+            "client": ("testclient", 50000),
+            "server": ("testserver", 80),
+        }
+        requests = [{"type": "http.request", "body": body, "more_body": False}]
+        disconnected = asyncio.Event()
+        sent = asyncio.Queue()
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async with main.lifespan(main.app):
+            task = asyncio.create_task(main.app(scope, receive, sent.put))
+            try:
+                start = await asyncio.wait_for(sent.get(), timeout=5)
+                assert start["type"] == "http.response.start"
+                assert b"content-encoding" not in dict(start["headers"])
+
+                first = await asyncio.wait_for(sent.get(), timeout=5)
+                assert first["type"] == "http.response.body"
+                assert first["body"].startswith(b"event: meta")
+                assert first["more_body"] is True
+                assert not task.done()
+            finally:
+                release.set()
+            await asyncio.wait_for(task, timeout=5)
+            disconnected.set()
+
+    asyncio.run(scenario())
+
+
+def test_llm_cache_key_keeps_history_turns_apart():
+    split_one = [{"role": "user", "content": "ab"}, {"role": "assistant", "content": "c"}]
+    split_two = [{"role": "user", "content": "a"}, {"role": "assistant", "content": "bc"}]
+
+    assert main._llm_cache_key("hello", "LOW", split_one) != main._llm_cache_key("hello", "LOW", split_two)
+    assert main._llm_cache_key("Hello ", "LOW", split_one) == main._llm_cache_key("hello", "LOW", split_one)
+    assert main._llm_cache_key("hello", "HIGH", split_one) is None
@@ -0,0 +1,111 @@
+"""
+Checks for CrisisDetector keyword scoring against a plain one-regex-per-pattern scan
+"""
+
+import random
+import re
+
+import pytest
+
+from app.crisis_detector import CrisisDetector
+
+
+@pytest.fixture(scope="module")
+def detector():
+    return CrisisDetector()
+
+
+def _reference_keywords(detector, message):
+    """Keyword score and signals the way the detector scored them before the patterns were fused"""
+    score = 0.0
+    signals = []
+    for category, data in detector.crisis_patterns.items():
+        for pattern in data['patterns']:
+            if re.search(pattern, message, re.IGNORECASE):
+                score += data['weight']
+                signals.append({'type': category, 'weight': data['weight'], 'matched_pattern': pattern})
+    protective = sum(1 for p in detector.protective_patterns if re.search(p, message, re.IGNORECASE))
+    if score and protective:
+        score *= 1 - protective * 0.15
+    return round(min(score, 1.0), 3), signals
+
+
+def _random_messages(count, seed=7):
+    fragments = [
+        "suicide", "kill myself", "end my life", "don't want to live", "want to die",
+        "cut myself", "self-harm", "self harm", "planned", "death", "how to end",
+        "methods of", "hopeless", "no hope", "give up", "all alone", "nobody understands",
+        "can't take it anymore", "so much pain", "help me", "need help", "in therapy",
+        "getting help", "friends care", "family supports", "SUICIDE", "Hopeless",
+        "suicides", "killing", "hopelessness", "selfharm", "I", "am", "today", "the",
+        "really", "work", "tired", "ok", ".", ",", "\n", "kill", "myself"
+    ]
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(fragments) for _ in range(rng.randint(0, 12)))
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize("message, categories", [
+    ("I want to kill myself", ["suicide"]),
+    ("I have been cutting and I hurt myself again", ["self_harm"]),
+    ("I planned my suicide", ["suicide", "plan"]),
+    ("Everything feels HOPELESS and I want to give up", ["hopelessness"]),
+    ("please help me, I'm all alone", ["isolation", "help_seeking"]),
+    ("Suicides in the news upset me", []),
+    ("I had a nice day at work", []),
+])
+def test_keyword_signals(detector, message, categories):
+    result = detector.analyze_message(message, [])
+
+    assert sorted({s['type'] for s in result['detected_signals']}) == sorted(categories)
+
+
+def test_keyword_score_matches_reference(detector):
+    for message in _random_messages(500):
+        score, signals = detector._keyword_analyze(message)
+        expected_score, expected_signals = _reference_keywords(detector, message)
+        assert round(min(score, 1.0), 3) == expected_score, message
+        assert [
+            {'type': c, 'weight': w, 'matched_pattern': p} for c, w, p in signals
+        ] == expected_signals, message
+
+
+def test_protective_factors_reduce_score(detector):
+    score, _ = detector._keyword_analyze("I feel hopeless")
+    protected, _ = detector._keyword_analyze("I feel hopeless but I'm in therapy and getting help")
+
+    assert score == 0.7
+    assert protected == pytest.approx(0.7 * (1 - 2 * 0.15))
+
+
+def test_plan_pattern_gap_is_bounded(detector):
+    def plan_signals(message):
+        return [p for c, _, p in detector._keyword_analyze(message)[1] if c == 'plan']
+
+    assert plan_signals("I planned my death")
+    assert plan_signals("I planned" + " " * 200 + "death")
+    assert not plan_signals("I planned" + " " * 201 + "death")
+    # The gap never spans lines
+    assert not plan_signals("I planned\nmy death")
+    assert plan_signals("methods for" + " " * 200 + "suicide")
+
+
+def test_batch_analyze_matches_analyze(detector):
+    messages = _random_messages(300, seed=11) + ["", "kill", "myself", "want to", "die"]
+    batch = detector.batch_analyze(messages)
+
+    assert len(batch) == len(messages)
+    for message, result in zip(messages, batch):
+        single = detector.analyze_message(message, [])
+        expected_score, _ = _reference_keywords(detector, message)
+        assert result['detected_signals'] == single['detected_signals'], message
+        assert result['crisis_score'] == expected_score, message
+
+
+def test_batch_analyze_keeps_hits_in_their_own_message(detector):
+    results = detector.batch_analyze(["I want to kill", "myself", "I planned", "death"])
+
+    assert [r['detected_signals'] for r in results] == [[], [], [], []]
+    assert detector.batch_analyze([]) == []
@@ -0,0 +1,81 @@
+"""
+Checks for request coalescing in LLMBatcher
+"""
+
+import asyncio
+
+from app.llm_batcher import LLMBatcher
+
+
+class CountingClient:
+    """Counts generate_response calls; each one waits until released"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def generate_response(self, user_message, conversation_history, crisis_context=None):
+        self.calls += 1
+        await self.release.wait()
+        return {'text': user_message, 'input_tokens': 5, 'output_tokens': 5,
+                'total_tokens': 10, 'estimated_cost': 0.5}
+
+
+def _request(message, risk_level='LOW'):
+    return {'user_message': message, 'conversation_history': [],
+            'crisis_context': {'risk_level': risk_level}}
+
+
+def test_identical_prompts_share_one_call_and_one_charge():
+    async def scenario():
+        client = CountingClient()
+        batcher = LLMBatcher(client)
+        batcher.start()
+        waiters = [asyncio.create_task(batcher.generate('key', **_request('same'))) for _ in range(3)]
+        await asyncio.sleep(0)
+        client.release.set()
+        results = await asyncio.gather(*waiters)
+        await batcher.stop()
+        return client.calls, results
+
+    calls, results = asyncio.run(scenario())
+
+    assert calls == 1
+    assert [r['text'] for r in results] == ['same'] * 3
+    assert sum(r['total_tokens'] for r in results) == 10
+    assert sum(r['estimated_cost'] for r in results) == 0.5
+
+
+def test_unkeyed_and_high_risk_requests_are_never_shared():
+    async def scenario():
+        client = CountingClient()
+        client.release.set()
+        batcher = LLMBatcher(client)
+        batcher.start()
+        await asyncio.gather(
+            batcher.generate(None, **_request('a')),
+            batcher.generate(None, **_request('a')),
+            batcher.generate('key', **_request('b', 'HIGH')),
+            batcher.generate('key', **_request('b', 'HIGH')),
+        )
+        await batcher.stop()
+        return client.calls
+
+    assert asyncio.run(scenario()) == 4
+
+
+def test_stop_waits_for_calls_in_flight():
+    async def scenario():
+        client = CountingClient()
+        batcher = LLMBatcher(client)
+        batcher.start()
+        waiter = asyncio.create_task(batcher.generate('key', **_request('slow')))
+        await asyncio.sleep(0)
+        stopping = asyncio.create_task(batcher.stop())
+        await asyncio.sleep(0)
+        assert not stopping.done()
+        client.release.set()
+        await stopping
+        return await waiter
+
+    assert asyncio.run(scenario())['text'] == 'slow'
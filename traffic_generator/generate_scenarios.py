@@ -4,10 +4,15 @@ Simulates various conversation scenarios to test detection rules
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
 import time
 import random
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +24,34 @@ class ScenarioGenerator:
     def __init__(self, base_url: str = "http://localhost:8080"):
         self.base_url = base_url
         self.scenarios = self._define_scenarios()
+        # Flattened once so the stress-test loop samples from ready-made tuples
+        self._scenario_names = tuple(self.scenarios)
+        self._all_messages = tuple(m for msgs in self.scenarios.values() for m in msgs)
+        self._rng = random.Random()
+        
+        # One pooled session so scenario messages reuse keep-alive connections
+        self._http = self._new_http_session()
+    
+    @staticmethod
+    def _new_http_session() -> requests.Session:
+        """
+        HTTP session with connection pooling. Only retries what the server
+        never processed: failed connects and 429/503 rejections.
+        """
+        retry = Retry(
+            total=3,
+            connect=3,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=(429, 503),
+            allowed_methods=frozenset({'POST'}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+        http = requests.Session()
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        return http
     
     def _define_scenarios(self) -> Dict[str, List[str]]:
         """Define test scenarios with varying risk levels"""
@@ -112,40 +145,46 @@ class ScenarioGenerator:
             ]
         }
     
-    def run_scenario(self, scenario_name: str, delay: float = 2.0) -> Dict:
+    def run_scenario(self, scenario_name: str, delay: float = 2.0, http: Optional[requests.Session] = None) -> Dict:
         """
         Run a specific scenario
         
         Args:
             scenario_name: Name of scenario to run
             delay: Delay between messages in seconds
+            http: Session to send with (default: the generator's shared session)
             
         Returns:
             Summary of the scenario execution
         """
         
         if scenario_name not in self.scenarios:
-            logger.error(f"Unknown scenario: {scenario_name}")
+            logger.error("Unknown scenario: %s", scenario_name)
             return {}
         
         messages = self.scenarios[scenario_name]
         session_id = f"test_{scenario_name}_{int(time.time())}"
         
-        logger.info(f"\n{'='*60}")
-        logger.info(f"Running scenario: {scenario_name}")
-        logger.info(f"Session ID: {session_id}")
-        logger.info(f"{'='*60}\n")
+        logger.info("\n%s", '='*60)
+        logger.info("Running scenario: %s", scenario_name)
+        logger.info("Session ID: %s", session_id)
+        logger.info("%s\n", '='*60)
         
+        http = http or self._http
         results = []
         crisis_detected = False
         max_risk_level = "LOW"
         max_crisis_score = 0.0
         
+        # Rapid-fire scenarios send faster
+        sleep_time = 0.5 if 'rapid' in scenario_name.lower() else delay
+        last_index = len(messages) - 1
+        
         for i, message in enumerate(messages):
-            logger.info(f"[Message {i+1}/{len(messages)}] User: {message}")
+            logger.info("[%s] [Message %s/%s] User: %s", scenario_name, i+1, len(messages), message)
             
             try:
-                response = requests.post(
+                response = http.post(
                     f"{self.base_url}/chat",
                     json={
                         "session_id": session_id,
@@ -157,8 +196,8 @@ class ScenarioGenerator:
                 response.raise_for_status()
                 data = response.json()
                 
-                logger.info(f"[Response] Bot: {data['response'][:100]}...")
-                logger.info(f"[Risk] Level: {data['risk_level']}, Score: {data.get('crisis_score', 'N/A')}")
+                logger.info("[Response] Bot: %s...", data['response'][:100])
+                logger.info("[Risk] Level: %s, Score: %s", data['risk_level'], data.get('crisis_score', 'N/A'))
                 
                 if data.get('crisis_detected'):
                     crisis_detected = True
@@ -178,14 +217,12 @@ class ScenarioGenerator:
                     'crisis_detected': data.get('crisis_detected', False)
                 })
                 
-                # Wait before next message (except for rapid-fire scenarios)
-                if 'rapid' not in scenario_name.lower() and i < len(messages) - 1:
-                    time.sleep(delay)
-                elif 'rapid' in scenario_name.lower():
-                    time.sleep(0.5)  # Faster for rapid-fire
+                # Wait before next message
+                if i < last_index:
+                    time.sleep(sleep_time)
                 
             except requests.RequestException as e:
-                logger.error(f"Request failed: {str(e)}")
+                logger.error("Request failed: %s", e)
                 results.append({
                     'message': message,
                     'error': str(e)
@@ -200,31 +237,46 @@ class ScenarioGenerator:
             'results': results
         }
         
-        logger.info(f"\n{'='*60}")
-        logger.info(f"Scenario Complete: {scenario_name}")
-        logger.info(f"Crisis Detected: {crisis_detected}")
-        logger.info(f"Max Risk Level: {max_risk_level}")
-        logger.info(f"{'='*60}\n")
+        logger.info("\n%s", '='*60)
+        logger.info("Scenario Complete: %s", scenario_name)
+        logger.info("Crisis Detected: %s", crisis_detected)
+        logger.info("Max Risk Level: %s", max_risk_level)
+        logger.info("%s\n", '='*60)
         
         return summary
     
-    def run_all_scenarios(self, delay_between_scenarios: float = 5.0):
-        """Run all defined scenarios"""
+    def run_all_scenarios(self, delay_between_scenarios: float = 5.0, max_parallel: int = 1):
+        """
+        Run all defined scenarios
         
-        logger.info(f"\n{'#'*60}")
-        logger.info(f"Starting Full Scenario Test Suite")
-        logger.info(f"Total Scenarios: {len(self.scenarios)}")
-        logger.info(f"{'#'*60}\n")
+        Args:
+            delay_between_scenarios: Pause between scenarios when run one at a time
+            max_parallel: Scenarios run at once (default: 1, back to back).
+                Messages within a scenario are always sent in order; when
+                scenarios overlap there is no pause between them.
+        """
+        
+        logger.info("\n%s", '#'*60)
+        logger.info("Starting Full Scenario Test Suite")
+        logger.info("Total Scenarios: %s", len(self.scenarios))
+        logger.info("%s\n", '#'*60)
+        
+        if max_parallel > 1:
+            # Scenarios are independent sessions, so they can overlap
+            with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='scenario') as pool:
+                all_results = list(pool.map(self._run_scenario_own_session, self._scenario_names))
+            self._print_summary(all_results)
+            return all_results
         
         all_results = []
         
-        for scenario_name in self.scenarios.keys():
+        for scenario_name in self._scenario_names:
             result = self.run_scenario(scenario_name)
             all_results.append(result)
             
             # Wait between scenarios
-            if scenario_name != list(self.scenarios.keys())[-1]:
-                logger.info(f"Waiting {delay_between_scenarios}s before next scenario...\n")
+            if scenario_name != self._scenario_names[-1]:
+                logger.info("Waiting %ss before next scenario...\n", delay_between_scenarios)
                 time.sleep(delay_between_scenarios)
         
         # Print summary
@@ -232,81 +284,110 @@ class ScenarioGenerator:
         
         return all_results
     
-    def run_stress_test(self, duration_seconds: int = 60):
+    def _run_scenario_own_session(self, scenario_name: str) -> Dict:
+        """run_scenario on a fresh HTTP session; requests.Session isn't thread-safe"""
+        with self._new_http_session() as http:
+            return self.run_scenario(scenario_name, http=http)
+    
+    def run_stress_test(self, duration_seconds: int = 60, concurrency: int = 50):
         """
         Run a stress test with random scenarios
         
         Args:
             duration_seconds: How long to run the stress test
+            concurrency: Maximum requests in flight at once
         """
-        
-        logger.info(f"\n{'#'*60}")
-        logger.info(f"Starting Stress Test - Duration: {duration_seconds}s")
-        logger.info(f"{'#'*60}\n")
+        asyncio.run(self._run_stress_test(duration_seconds, concurrency))
+    
+    async def _run_stress_test(self, duration_seconds: int, concurrency: int):
+        logger.info("\n%s", '#'*60)
+        logger.info("Starting Stress Test - Duration: %ss, Concurrency: %s", duration_seconds, concurrency)
+        logger.info("%s\n", '#'*60)
         
         start_time = time.time()
-        request_count = 0
+        deadline = start_time + duration_seconds
+        completions = []  # completion timestamps of successful requests
         
-        while time.time() - start_time < duration_seconds:
-            # Pick random scenario
-            scenario_name = random.choice(list(self.scenarios.keys()))
-            messages = self.scenarios[scenario_name]
-            
-            # Pick random message from scenario
-            message = random.choice(messages)
-            session_id = f"stress_{int(time.time())}_{request_count}"
-            
+        # Each worker keeps one request in flight, so `concurrency` of them
+        # overlap their round trips instead of waiting on each other
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            workers = [
+                self._stress_worker(session, worker_id, deadline, completions)
+                for worker_id in range(concurrency)
+            ]
             try:
-                requests.post(
-                    f"{self.base_url}/chat",
-                    json={
-                        "session_id": session_id,
-                        "user_message": message
-                    },
-                    timeout=10
-                )
-                request_count += 1
-                
-                if request_count % 10 == 0:
-                    logger.info(f"Stress test: {request_count} requests sent...")
-                
-            except Exception as e:
-                logger.error(f"Stress test request failed: {str(e)}")
-            
-            # Small delay
-            time.sleep(random.uniform(0.1, 0.5))
+                # Requests still in flight at the deadline get their timeout to finish
+                await asyncio.wait_for(asyncio.gather(*workers), duration_seconds + timeout.total)
+            except asyncio.TimeoutError:
+                logger.warning("Stress test workers did not finish in time")
         
-        elapsed = time.time() - start_time
-        rps = request_count / elapsed
+        request_count = len(completions)
+        elapsed = (completions[-1] if completions else time.time()) - start_time
+        rps = request_count / elapsed if elapsed > 0 else 0.0
         
-        logger.info(f"\n{'#'*60}")
-        logger.info(f"Stress Test Complete")
-        logger.info(f"Total Requests: {request_count}")
-        logger.info(f"Duration: {elapsed:.2f}s")
-        logger.info(f"Requests/Second: {rps:.2f}")
-        logger.info(f"{'#'*60}\n")
+        logger.info("\n%s", '#'*60)
+        logger.info("Stress Test Complete")
+        logger.info("Total Requests: %s", request_count)
+        logger.info("Duration: %.2fs", elapsed)
+        logger.info("Requests/Second: %.2f", rps)
+        logger.info("%s\n", '#'*60)
+    
+    async def _stress_worker(self, session, worker_id: int, deadline: float, completions: List[float]):
+        sent = 0
+        while time.time() < deadline:
+            # Every scenario has the same number of messages, so a flat pick
+            # weights scenarios exactly as picking a scenario first did
+            message = self._rng.choice(self._all_messages)
+            session_id = f"stress_{int(time.time())}_{worker_id}_{sent}"
+            sent += 1
+            
+            if await self._afire(session, message, session_id):
+                completions.append(time.time())
+                if len(completions) % 10 == 0:
+                    logger.info("Stress test: %s requests sent...", len(completions))
+            
+            # Small jitter so workers don't fire in lockstep
+            await asyncio.sleep(self._rng.uniform(0, 0.05))
+    
+    async def _afire(self, session, message: str, session_id: str) -> bool:
+        """Post one stress-test message; True if the server answered successfully"""
+        try:
+            async with session.post(
+                f"{self.base_url}/chat",
+                json={
+                    "session_id": session_id,
+                    "user_message": message
+                }
+            ) as response:
+                await response.read()
+                response.raise_for_status()
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error("Stress test request failed: %s", str(e) or type(e).__name__)
+            return False
     
     def _print_summary(self, results: List[Dict]):
         """Print summary of all scenario results"""
         
-        logger.info(f"\n{'#'*60}")
-        logger.info(f"TEST SUITE SUMMARY")
-        logger.info(f"{'#'*60}\n")
+        logger.info("\n%s", '#'*60)
+        logger.info("TEST SUITE SUMMARY")
+        logger.info("%s\n", '#'*60)
         
         total = len(results)
         crisis_detected = sum(1 for r in results if r.get('crisis_detected'))
         high_risk = sum(1 for r in results if r.get('max_risk_level') == 'HIGH')
         medium_risk = sum(1 for r in results if r.get('max_risk_level') == 'MEDIUM')
         
-        logger.info(f"Total Scenarios: {total}")
-        logger.info(f"Crisis Detected: {crisis_detected}")
-        logger.info(f"High Risk: {high_risk}")
-        logger.info(f"Medium Risk: {medium_risk}")
-        logger.info(f"\nDetailed Results:")
+        logger.info("Total Scenarios: %s", total)
+        logger.info("Crisis Detected: %s", crisis_detected)
+        logger.info("High Risk: %s", high_risk)
+        logger.info("Medium Risk: %s", medium_risk)
+        logger.info("\nDetailed Results:")
         
         for result in results:
             status = "🚨 CRISIS" if result.get('crisis_detected') else "✓ Normal"
-            logger.info(f"  {status} | {result['scenario']} | Risk: {result['max_risk_level']}")
+            logger.info("  %s | %s | Risk: %s", status, result['scenario'], result['max_risk_level'])
 
 
 def main():
@@ -320,6 +401,8 @@ def main():
     parser.add_argument('--all', action='store_true', help='Run all scenarios')
     parser.add_argument('--stress', action='store_true', help='Run stress test')
     parser.add_argument('--duration', type=int, default=60, help='Stress test duration (seconds)')
+    parser.add_argument('--concurrency', type=int, default=50, help='Stress test requests in flight')
+    parser.add_argument('--parallel', type=int, default=1, help='Scenarios run at once with --all (default: 1)')
     
     args = parser.parse_args()
     
@@ -328,9 +411,9 @@ def main():
     if args.scenario:
         generator.run_scenario(args.scenario)
     elif args.all:
-        generator.run_all_scenarios()
+        generator.run_all_scenarios(max_parallel=args.parallel)
     elif args.stress:
-        generator.run_stress_test(duration_seconds=args.duration)
+        generator.run_stress_test(duration_seconds=args.duration, concurrency=args.concurrency)
     else:
         # Default: run a few key scenarios
         for scenario in ['low_risk_general', 'medium_risk_hopeless', 'high_risk_immediate']: